@@ -178,7 +178,8 @@ class Battle(cocos.layer.Layer):
 
     def select_ship(self):
         "Make the entity the selected ship."
-        self.battle_grid.highlight_ships([self.selected], grid.SHIP_SELECTED)
+        self.battle_grid.set_overlay('selected',
+                                     self.battle_grid.get_ships_cells([self.selected]))
         # If ship didn't move yet, calculate and highlight the reachable cells
         self.show_reachable_cells()
         # Get targets in range
@@ -188,7 +189,7 @@ class Battle(cocos.layer.Layer):
         "calculate and highlight the reachable cells"
         if not self.selected.move_completed:
             self.get_reachable_cells(self.selected)
-            self.battle_grid.highlight_cells(self.reachable_cells, grid.REACHABLE_CELLS)
+            self.battle_grid.set_overlay('reachable', self.reachable_cells)
 
     def get_reachable_cells(self, ship):
         "Calculate the reachable cells"
@@ -200,21 +201,24 @@ class Battle(cocos.layer.Layer):
         if not self.selected.attack_completed \
            and self.selected.weapon is not None:
             self.targets = self.battle_grid.get_targets(self.selected)
-            self.battle_grid.highlight_ships(self.targets, grid.TARGET)
+            self.battle_grid.set_overlay('target',
+                                         self.battle_grid.get_ships_cells(self.targets))
 
     def deselect_ship(self, ship):
         "Deselect the currently selected ship if in play."
-        self.battle_grid.highlight_ships([ship], grid.PLAYER_TURN)
+        cells = self.battle_grid.get_ships_cells([ship])
+        self.battle_grid.remove_overlay('selected', cells)
+        self.battle_grid.add_overlay('player turn', cells)
 
     def clear_reachable_cells(self):
         "Clear the reachable cells if any"
         if self.reachable_cells:
-            self.battle_grid.clear_cells(self.reachable_cells)
+            self.battle_grid.set_overlay('reachable', [])
 
     def deselect_targets(self):
         "Deselect the targeted ships"
         if self.targets:
-            self.battle_grid.clear_ships_highlight(self.targets)
+            self.battle_grid.set_overlay('target', [])
             self.targets = []
 
     def attack_ship(self, attacker, defender):
@@ -230,6 +234,7 @@ class Battle(cocos.layer.Layer):
 #""") % (attacker.player.name, defender.player.name)
 
     def on_weapon_change(self):
+        self.battle_grid.update_view_ranges()
         self.deselect_targets()
         self.show_targets()
 
@@ -239,6 +244,7 @@ class Battle(cocos.layer.Layer):
             self.show_reachable_cells()
 
     def on_weapon_jammed(self, weapon):
+        self.battle_grid.update_view_ranges()
         self.msg += _("Major Failure ! You will need a tech to use {weapon.name} again.{{}}\n").format(weapon=weapon)
 
     def on_damage(self, ship, dmg):
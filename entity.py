@@ -1,5 +1,7 @@
 import random, json, fractions, abc, collections
 
+import numpy as np
+
 import cocos
 from cocos.text import *
 from cocos.actions import CallFunc, Delay
@@ -8,7 +10,7 @@ import pyglet
 from pyglet import event
 from pyglet.gl import *
 
-import main, ia, grid
+import main, ia, grid, resources
 
 COOLDOWN = 100
 
@@ -351,10 +353,8 @@ class BoostShield(Boost):
 class Ship(cocos.sprite.Sprite):
     
     # We prepare the explosion animation
-    raw = pyglet.resource.image('explosion.png')
-    raw_seq = pyglet.image.ImageGrid(raw, 1, 90)
-    texture_seq = pyglet.image.TextureGrid(raw_seq)
-    explosion_anim = pyglet.image.Animation.from_image_sequence(texture_seq, 0.02, False)
+    explosion_anim = pyglet.image.Animation.from_image_sequence(
+                        resources.get_image('explosion.png'), 0.02, False)
     
     def __init__( self, image, ship_type, slots, speed, hull, shield):
         """
@@ -614,11 +614,85 @@ class Player(object):
             return player
         return None
 
+class AsteroidAnimation(object):
+    """
+    Looping animation shared by the asteroids turning at the same speed.
+    The frames are regions of the same texture, so advancing the animation
+    only changes the texture coords of the sprites. They are written for
+    all its asteroids at once, with one numpy assignment by vertex buffer.
+    """
+    def __init__(self, frames, duration):
+        self.frames = frames
+        self.duration = duration
+        # The texture coords of the frames, as [frame, vertex, component]
+        self.tex_coords = np.array([frame.tex_coords for frame in frames],
+                                   dtype=np.float32).reshape(len(frames), 4, 3)
+        # Steps advanced since the start
+        self.steps = 0
+        # The animated asteroids, with the frame they show minus steps
+        self.offsets = {}
+        # The animated asteroids grouped by vertex domain, see _group
+        self._groups = None
+
+    def add(self, asteroid):
+        "Animate the asteroid from the frame it shows."
+        self.offsets[asteroid] = asteroid.current_frame - self.steps
+        self._groups = None
+
+    def discard(self, asteroid):
+        "Stop animating the asteroid, which keeps showing its current frame."
+        offset = self.offsets.pop(asteroid, None)
+        if offset is not None:
+            asteroid.current_frame = (offset + self.steps) % len(self.frames)
+            self._groups = None
+
+    def __contains__(self, asteroid):
+        return asteroid in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _group(self):
+        """
+        Returns the animated asteroids as a list of (vertex domain, first
+        vertex of each sprite, frame offsets) by domain of their vertex lists.
+        """
+        groups = collections.defaultdict(lambda: ([], []))
+        for asteroid, offset in self.offsets.items():
+            vertex_list = asteroid._vertex_list
+            starts, offsets = groups[vertex_list.domain]
+            starts.append(vertex_list.start)
+            offsets.append(offset)
+        return [(domain, np.array(starts), np.array(offsets))
+                for domain, (starts, offsets) in groups.items()]
+
+    def advance(self, steps):
+        "Show the frame steps further for all the animated asteroids."
+        self.steps += steps
+        if self._groups is None:
+            self._groups = self._group()
+        for domain, starts, offsets in self._groups:
+            # A single region of the buffer covers all the sprites.
+            attribute = domain.attribute_names['tex_coords']
+            first = int(starts.min())
+            region = attribute.get_region(attribute.buffer, first,
+                                          int(starts.max()) + 4 - first)
+            tex_coords = np.ctypeslib.as_array(region.array).reshape(-1, 3)
+            vertices = (starts - first)[:, np.newaxis] + np.arange(4)
+            tex_coords[vertices] = self.tex_coords[(offsets + self.steps) % len(self.frames)]
+            region.invalidate()
+
 class Asteroid(cocos.sprite.Sprite):
-    def __init__(self, image, *args, **kwargs):
-         super(Asteroid, self).__init__(image, *args, **kwargs)
-         frame_num = len(image.frames)
-         self._frame_index = random.randint(0, frame_num-1)
+    """
+    Asteroid showing one frame of an AsteroidAnimation shared with other
+    asteroids. It has no clock of its own: its GridLayer advances the
+    frames of all the asteroids of the same animation at once.
+    current_frame is the frame shown while the asteroid is not animated.
+    """
+    def __init__(self, animation, *args, **kwargs):
+         self.animation = animation
+         self.current_frame = random.randint(0, len(animation.frames)-1)
+         super(Asteroid, self).__init__(animation.frames[self.current_frame], *args, **kwargs)
 
 class DifficultTerrain(cocos.sprite.Sprite):
     def __init__(self, image, *args, **kwargs):
@@ -655,7 +729,7 @@ class ShipFactory(object):
                     energy_idx = EnergyType.names.index(shield['energy_type'])
                     shields[energy_idx] = shield['pr']
                 self.ships[v['ship_type']] = \
-                    (v['image'].encode('utf-8'), # cocos.Sprite needs a str, not a unicode
+                    (resources.get_image(v['image']),
                      v['ship_type'],
                      v['slots'],
                      v['speed'],
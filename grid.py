@@ -1,12 +1,13 @@
-import math
+import math, heapq, collections
 from random import shuffle, randint, uniform, choice
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import dijkstra
 
 import cocos
 import cocos.euclid as eu
 from cocos.director import director
+from cocos.framegrabber import TextureGrabber, FBOGrabber
 from cocos.actions import (
     MoveTo, InstantAction, Repeat, RotateBy, RotateTo, Delay,
     CallFunc, CallFuncS, ScaleTo, AccelDeccel, Show, Hide)
@@ -15,7 +16,7 @@ import pyglet
 from pyglet.window import key
 from pyglet.gl import *
 
-import entity, simplexnoise, library, battle, laser
+import entity, library, battle, laser, terrain, resources
 
 CELL_WIDTH = 50
 
@@ -25,6 +26,64 @@ REACHABLE_CELLS = [128, 0, 128, 100]
 TARGET = [255, 0, 0, 100]
 CLEAR_CELL = [0, 0, 0, 0]
 
+# Highlight overlays of the cells by increasing priority, with their colors.
+# See GridLayer.set_overlay.
+OVERLAYS = [('player turn', PLAYER_TURN), ('selected', SHIP_SELECTED),
+            ('reachable', REACHABLE_CELLS), ('target', TARGET)]
+OVERLAY_COLORS = dict(OVERLAYS)
+
+# Default number of reachable cells results kept by a GridLayer
+REACHABLE_CACHE_SIZE = 128
+# Default number of distance fields kept by a GridLayer
+FIELD_CACHE_SIZE = 16
+# Default pathfinding backend, see PATHFINDERS
+PATHFINDING = "distance matrix"
+# Default directory and size in bytes of the cache of generated terrains.
+# Set 'terrain cache' to null in the battlemap to disable it.
+TERRAIN_CACHE_DIR = "cache"
+TERRAIN_CACHE_SIZE = 64 * 2**20
+# Changes whenever the arrays stored in the terrain cache change
+TERRAIN_CACHE_FORMAT = 1
+# The keywords of the battlemap the generated terrain depends on. Only they
+# make the key of the terrain cache, so the other settings can change
+# without generating the terrain again.
+TERRAIN_KEYWORDS = ('col', 'row', 'obstacle', 'difficult terrain')
+# Default number of chunks kept in memory when the battlemap sets 'chunk size'
+LOADED_CHUNKS = 256
+# Default distance up to which the lines of sight are indexed, see LineOfSight
+LOS_RANGE = 15
+# Default number of cells whose lines of sight are kept by a LineOfSight
+LOS_CACHE_SIZE = 4096
+# Default size of the square buckets of cells of the ships spatial index
+SHIP_BUCKET_SIZE = 8
+# Default distance the sensors of a ship see, see FleetVisibility
+SENSOR_RANGE = 10
+# Default size of the square buckets of cells whose sprites are drawn together
+SPRITE_BUCKET_SIZE = 16
+# Number of cells around the view whose sprites are drawn anyway
+VIEW_MARGIN = 2
+# Durations of the frames of the asteroid animations. The asteroids are spread
+# among them and share their animation.
+ASTEROID_FRAME_DURATIONS = [0.07, 0.09, 0.11, 0.13, 0.15]
+# Zoom levels of the scroller, see on_key_release. The background is rendered
+# once in a texture for each of them. While zooming, it is tiled every frame.
+ZOOM_LEVELS = (0.75, 1., 1.25)
+# Default size in bytes of the textures of the rendered backgrounds. The zoom
+# levels whose texture does not fit are tiled every frame.
+BACKGROUND_CACHE_SIZE = 64 * 2**20
+
+# Bit flags of the occupancy raster of a GridLayer
+ASTEROID = 1
+NEBULA = 2
+SHIP = 4
+# The id of the player of a ship, see ShipTable.owner_id, is stored in the
+# bits above PLAYER_SHIFT
+PLAYER_SHIFT = 3
+PLAYER_BITS = 0xff ^ (2**PLAYER_SHIFT - 1)
+
+# The 8 neighbours of a cell as (x_offset, y_offset)
+NEIGHBOURS = [(x, y) for y in (-1, 0, 1) for x in (-1, 0, 1) if x or y]
+
 class GridLayer(cocos.layer.ScrollableLayer):
     def __init__(self, map_kwargs):
         """
@@ -35,9 +94,17 @@ class GridLayer(cocos.layer.ScrollableLayer):
         super( GridLayer, self ).__init__()
         # Batch for the grid
         self.grid_batch = pyglet.graphics.Batch()
-        # Batch for the asteroids
-        self.sprite_batch = cocos.batch.BatchNode()
-        self.add(self.sprite_batch)
+        # The asteroids and difficult terrains are drawn by one batch per
+        # bucket of sprite_bucket_size x sprite_bucket_size cells, so only the
+        # buckets in view are drawn and animated. See cull_sprites.
+        self.sprite_layer = cocos.cocosnode.CocosNode()
+        self.add(self.sprite_layer)
+        self.sprite_bucket_size = map_kwargs.get('sprite bucket size', SPRITE_BUCKET_SIZE)
+        # Batches by bucket (x, y), see sprite_bucket
+        self.sprite_buckets = {}
+        # The buckets and ships in view, None until the first view is set
+        self.buckets_in_view = None
+        self.ships_in_view = None
 
         # Size of the grid
         self.col, self.row = map_kwargs['col'], map_kwargs['row']
@@ -45,64 +112,90 @@ class GridLayer(cocos.layer.ScrollableLayer):
         self.px_width = (self.col) * CELL_WIDTH
         self.px_height = (self.row) * CELL_WIDTH
 
-        # Grid squares and borders
-        self.squares = [[None for _ in range(self.row)] for _ in range(self.col)]
+        # Grid borders
         self.borders = []
+        # The cells (i, j) of each highlight overlay, see OVERLAYS
+        self.overlays = dict((name, set()) for name, _ in OVERLAYS)
+        # The overlay painted on each highlighted cell, and the cells whose
+        # overlays changed since they were last painted
+        self.painted = {}
+        self.dirty_cells = set()
 
         # Each entity type has a dict {(i, j): entity}
         self.entities = {'asteroids' : {}, 'diff_terrain' : {}, 'ships': {}}
-
-        # We build the obstacles and difficult terrains
-        # We get a set of coordinates for each type of terrain. We don't want
-        # obstacles on the same place as difficult terrains. So we take the difference
-        # between both sets to get the terrain.
-        diff_terrain_pos = self.generate_noise_terrain(map_kwargs['difficult terrain'])
-        asteroids_pos = self.generate_noise_terrain(map_kwargs['obstacle']) - diff_terrain_pos
-
-        # Create the asteroids animated sprites
-        raw = pyglet.resource.image('aster3.png')
-        raw_seq = pyglet.image.ImageGrid(raw, 6, 5)
-        texture_seq = pyglet.image.TextureGrid(raw_seq)
-
-        for x, y in asteroids_pos:
-            rotation_speed = uniform(0.07, 0.15)
-            anim = pyglet.image.Animation.from_image_sequence(texture_seq, rotation_speed, True)
-            asteroid = entity.Asteroid(anim, position=self.from_grid_to_pixel(x,y),
-                                                         rotation = uniform(0, 360))
-            self.sprite_batch.add(asteroid)
-            self.entities['asteroids'][(x, y)] = asteroid
-
-        # Create the difficult terrain sprites
-        raw = pyglet.resource.image('nebulaes.png')
-        raw_grid = pyglet.image.ImageGrid(raw, 3, 3, row_padding=1, column_padding=1)
-        texture_grid = pyglet.image.TextureGrid(raw_grid)
-        # max_len = len(texture_grid)
-
-        for x, y in diff_terrain_pos:
-            diff_terrain = entity.DifficultTerrain(choice(texture_grid),
-                            position=self.from_grid_to_pixel(x,y))
-            self.sprite_batch.add(diff_terrain)
-            self.entities['diff_terrain'][(x, y)] = diff_terrain
-
-        # We build the distance matrix.
-        self.dist_mat = DistanceMatrix(self.row, self.col)
-        self.dist_mat.add_obstacles( self.entities['asteroids'].keys() )
-        self.dist_mat.add_difficult_terrains(map_kwargs['difficult terrain']['cost factor'],
-                                        self.entities['diff_terrain'].keys())
+        # What is in each cell as bit flags (ASTEROID, NEBULA, SHIP and the
+        # player of the ship) by cell number, kept with the dicts entities.
+        # The queries on the cells look in there, the dicts are the sprites.
+        self.occupancy = None
+        # The cells and owners of the ships as arrays, kept with entities['ships']
+        self.ship_table = ShipTable(map_kwargs.get('ship bucket size', SHIP_BUCKET_SIZE))
+        # Changes whenever the terrain or the ships occupancy changes.
+        self.version = 0
+        # Reachable cells and predecessors by (origin cell, speed, version)
+        self.reachable_cache = library.LRUCache(
+                map_kwargs.get('reachable cache size', REACHABLE_CACHE_SIZE))
+        # Distance fields by (target cells, version)
+        self.field_cache = library.LRUCache(
+                map_kwargs.get('field cache size', FIELD_CACHE_SIZE))
+
+        # Textures of the asteroids animated sprites
+        self.asteroid_seq = resources.get_image('aster3.png')
+        self.asteroid_anims = [entity.AsteroidAnimation(self.asteroid_seq, duration)
+                               for duration in ASTEROID_FRAME_DURATIONS]
+        # The time since the last frame of each animation. The asteroids in
+        # view are added to their animation and advanced by animate_asteroids.
+        self.animation_clocks = dict((anim, 0.) for anim in self.asteroid_anims)
+        # Textures of the difficult terrain sprites
+        self.nebula_grid = resources.get_image('nebulaes.png')
+
+        # On huge battlemaps, the terrain is split into chunks which are only
+        # generated when they are used. See TerrainChunks.
+        self.terrain = None
+        if map_kwargs.get('chunk size'):
+            self._init_chunked_terrain(map_kwargs)
+        else:
+            self._init_terrain(map_kwargs)
+        # On big maps, long paths are searched through clusters of cells.
+        # The clusters are built over the whole terrain, which would generate
+        # every chunk: they cannot be used with chunks.
+        self.hierarchy = None
+        if 'cluster size' in map_kwargs:
+            if self.terrain is not None:
+                raise ValueError("the battlemap cannot set both 'cluster size' "
+                                 "and 'chunk size'")
+            self.hierarchy = ClusterGraph(self.pathfinder, map_kwargs['cluster size'])
+        # Which cells the asteroids hide from each other
+        self.line_of_sight = LineOfSight(self.pathfinder,
+                map_kwargs.get('los range', LOS_RANGE),
+                map_kwargs.get('los cache size', LOS_CACHE_SIZE))
+        # Fog of war: the cells the fleet of each player sees
+        self.visibility = FleetVisibility(self.pathfinder,
+                map_kwargs.get('sensor range', SENSOR_RANGE))
 
         # Background image
         img=pyglet.resource.image("outer-space.jpg")
         self.bg_texture = pyglet.image.TileableTexture.create_for_image(img)
-
-        # We construct the quads and store them for future reference
-        for row in range(self.row):
-            for col in range(self.col):
-                self.squares[col][row] = self.grid_batch.add(4, GL_QUADS, pyglet.graphics.OrderedGroup(1),
-                            ('v2f', (col*CELL_WIDTH, row*CELL_WIDTH, col*CELL_WIDTH, (row+1)*CELL_WIDTH,
-                                     (col+1)*CELL_WIDTH, (row+1)*CELL_WIDTH, (col+1)*CELL_WIDTH, row*CELL_WIDTH)),
-                            ('c4B', (128, 128, 128, 0) * 4))
-
-
+        # The background rendered by zoom level, see draw_background, and the
+        # bytes taken by their textures
+        self.bg_cache = {}
+        self.bg_cache_size = map_kwargs.get('background cache size', BACKGROUND_CACHE_SIZE)
+        self.bg_cache_bytes = 0
+
+        # The quads of the cells, in one vertex list by shown chunk, or a
+        # single one for the whole grid (key None) without chunks. Each
+        # vertex list has its own group under quads_group, so its own vertex
+        # domain: adding the quads of a chunk never resizes the buffers of
+        # the others, which cell_colors points to.
+        self.quads_group = pyglet.graphics.OrderedGroup(1)
+        self.cell_quads = {}
+        # The colors of the quads as numpy views on the vertex buffers, by
+        # the same keys, indexed by [cell number in the box, vertex,
+        # component]. They are sent to the graphic card by the next draw
+        # after their key is added to colors_changed.
+        self.cell_colors = {}
+        self.colors_changed = set()
+        if self.terrain is None:
+            self._add_cell_quads(None, (0, 0, self.col, self.row))
 
         # We build the lines of the grid.
         lines=[]
@@ -142,6 +235,86 @@ class GridLayer(cocos.layer.ScrollableLayer):
             }
         # We want to call step every frame to scroll the map
         self.schedule(self.step)
+        # And to animate the asteroids
+        self.schedule(self.animate_asteroids)
+
+    def _init_terrain(self, map_kwargs):
+        """
+        Generate the whole terrain of the battlemap with its sprites and
+        build the pathfinding graph.
+        """
+        # The terrain and its pathfinding graph only depend on the battlemap.
+        # They are kept in a disk cache so the next battles can load them.
+        Pathfinder = PATHFINDERS[map_kwargs.get('pathfinding', PATHFINDING)]
+        terrain_cache, cached = None, None
+        if map_kwargs.get('terrain cache', TERRAIN_CACHE_DIR):
+            terrain_cache = library.DiskCache(
+                    map_kwargs.get('terrain cache', TERRAIN_CACHE_DIR),
+                    map_kwargs.get('terrain cache size', TERRAIN_CACHE_SIZE))
+            terrain_kwargs = dict((name, map_kwargs[name]) for name in TERRAIN_KEYWORDS)
+            cache_key = terrain_cache.make_key(terrain_kwargs, Pathfinder.__name__,
+                                               TERRAIN_CACHE_FORMAT)
+            cached = terrain_cache.get(cache_key)
+
+        if cached is not None:
+            diff_terrain_pos = self.from_mask_to_cells(cached['diff_terrain'])
+            asteroids_pos = self.from_mask_to_cells(cached['asteroids'])
+        else:
+            # We build the obstacles and difficult terrains
+            # We get a mask for each type of terrain, both computed at the same
+            # time. We don't want obstacles on the same place as difficult
+            # terrains. So we take the difference between both masks to get the terrain.
+            diff_terrain_mask, obstacle_mask = terrain.generate_masks(
+                    self.col, self.row,
+                    [map_kwargs['difficult terrain'], map_kwargs['obstacle']],
+                    map_kwargs.get('terrain processes'))
+            diff_terrain_pos = self.from_mask_to_cells(diff_terrain_mask)
+            asteroids_pos = self.from_mask_to_cells(obstacle_mask & ~diff_terrain_mask)
+
+        # Create the asteroids animated sprites
+        for x, y in asteroids_pos:
+            self._create_asteroid(x, y)
+
+        # Create the difficult terrain sprites
+        for x, y in diff_terrain_pos:
+            self._create_diff_terrain(x, y)
+
+        self.occupancy = np.zeros(self.row * self.col, dtype=np.uint8)
+        self.occupancy[self.from_cells_to_mask(asteroids_pos).T.ravel()] |= ASTEROID
+        self.occupancy[self.from_cells_to_mask(diff_terrain_pos).T.ravel()] |= NEBULA
+
+        # We build the pathfinding graph with its obstacles and difficult terrains.
+        # The backend can be chosen in the battlemap.
+        if cached is not None:
+            self.pathfinder = Pathfinder.from_arrays(self.row, self.col, cached)
+        else:
+            self.pathfinder = Pathfinder(self.row, self.col,
+                                obstacles=self.entities['asteroids'].keys(),
+                                cf=map_kwargs['difficult terrain']['cost factor'],
+                                diff_terrains=self.entities['diff_terrain'].keys())
+            if terrain_cache is not None:
+                arrays = self.pathfinder.to_arrays()
+                arrays['asteroids'] = self.from_cells_to_mask(asteroids_pos)
+                arrays['diff_terrain'] = self.from_cells_to_mask(diff_terrain_pos)
+                terrain_cache.put(cache_key, arrays)
+
+    def _init_chunked_terrain(self, map_kwargs):
+        """
+        Set up the terrain of the battlemap as chunks. The sprites of a
+        chunk are created when it comes into view, see set_view, and its
+        cells are generated when the pathfinding or the line of sight use
+        them. The pathfinding is matrix free, on the rasters of the chunks.
+        """
+        loaded_chunks = map_kwargs.get('loaded chunks', LOADED_CHUNKS)
+        self.terrain = TerrainChunks(self.row, self.col, map_kwargs,
+                                     map_kwargs['chunk size'], loaded_chunks)
+        self.pathfinder = CostRaster.from_arrays(self.row, self.col,
+                {'obstacle': self.terrain.obstacle,
+                 'cost_factor': self.terrain.cost_factor})
+        self.occupancy = self.terrain.occupancy
+        # The chunks whose sprites are created
+        self.shown_chunks = library.LRUCache(loaded_chunks,
+                                             on_evict=self._hide_chunk)
 
     def on_enter(self):
         "Called when the grid is displayed for the first time"
@@ -155,13 +328,234 @@ class GridLayer(cocos.layer.ScrollableLayer):
     def draw(self, *args, **kwargs):
         glPushMatrix()
         self.transform()
-        # Draw the background as a tileable texture over the grid.
-        grid_width, grid_height = self.col*CELL_WIDTH, self.row*CELL_WIDTH
-        self.bg_texture.blit_tiled(0, 0, 0, grid_width, grid_height)
+        self.draw_background()
+        self.paint_overlays()
+        # Getting the colors of a vertex list marks them to be uploaded
+        for chunk in self.colors_changed:
+            self.cell_quads[chunk].colors
+        self.colors_changed.clear()
         # Draw the rest
         self.grid_batch.draw()
         glPopMatrix()
 
+    def draw_background(self):
+        """
+        Draw the background as a tileable texture over the grid. At the zoom
+        levels of ZOOM_LEVELS, it is rendered once in a texture which is
+        drawn as a single quad.
+        """
+        grid_width, grid_height = self.col*CELL_WIDTH, self.row*CELL_WIDTH
+        scale = round(self.scroller.scale, 3)
+        if scale in ZOOM_LEVELS and scale not in self.bg_cache:
+            self.bg_cache[scale] = self._render_background(scale)
+        texture = self.bg_cache.get(scale)
+        if texture is not None:
+            texture.blit(0, 0, width=grid_width, height=grid_height)
+        else:
+            self.bg_texture.blit_tiled(0, 0, 0, grid_width, grid_height)
+
+    def _render_background(self, scale):
+        """
+        Returns a texture of the background of the grid with one texel per
+        pixel of the screen at the given scale, or None if it is too big
+        for the graphic card or for what is left of bg_cache_size.
+        """
+        grid_width, grid_height = self.col*CELL_WIDTH, self.row*CELL_WIDTH
+        width, height = int(grid_width * scale), int(grid_height * scale)
+        max_width = max_height = pyglet.image.atlas.get_max_texture_size()
+        grabber = TextureGrabber()
+        if not isinstance(grabber, FBOGrabber):
+            # Without frame buffer objects, the background is drawn in the
+            # back buffer of the window and copied into the texture.
+            buffer = pyglet.image.get_buffer_manager().get_color_buffer()
+            max_width, max_height = min(max_width, buffer.width), min(max_height, buffer.height)
+        size = width * height * 4
+        if (width > max_width or height > max_height or
+                self.bg_cache_bytes + size > self.bg_cache_size):
+            return None
+        self.bg_cache_bytes += size
+        texture = pyglet.image.Texture.create(width, height)
+        grabber.grab(texture)
+        grabber.before_render(texture)
+        # Draw in the whole texture, then restore the view of the director
+        viewport = (GLint * 4)()
+        glGetIntegerv(GL_VIEWPORT, viewport)
+        glViewport(0, 0, width, height)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(0, width, 0, height, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+        glScalef(scale, scale, 1)
+        self.bg_texture.blit_tiled(0, 0, 0, grid_width, grid_height)
+        glPopMatrix()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glViewport(*viewport)
+        grabber.after_render(texture)
+        return texture
+
+    def set_view(self, x, y, w, h, viewport_ox=0, viewport_oy=0):
+        "Called by the scrolling manager when the visible area of the grid changes."
+        super(GridLayer, self).set_view(x, y, w, h, viewport_ox, viewport_oy)
+        if self.terrain is not None:
+            self.show_chunks(x, y, w, h)
+        self.cull_sprites(x, y, w, h)
+
+    def cull_sprites(self, x, y, w, h):
+        """
+        Draw only the sprites in the given area in pixels, plus VIEW_MARGIN
+        cells around, and pause the animations of the asteroids out of it.
+        Only the buckets and ships which enter or leave the area are
+        changed, so the cost does not grow with the map. The moving ships
+        stay drawn until they stop.
+        """
+        margin = VIEW_MARGIN * CELL_WIDTH
+        x, y, w, h = x - margin, y - margin, w + 2 * margin, h + 2 * margin
+        size = self.sprite_bucket_size * CELL_WIDTH
+        in_view = set((bi, bj)
+                      for bi in range(int(x // size), int((x + w) // size) + 1)
+                      for bj in range(int(y // size), int((y + h) // size) + 1))
+        shown = self.buckets_in_view
+        if shown is None:
+            shown = set(self.sprite_buckets)
+        self.buckets_in_view = in_view
+        for bucket in shown - in_view:
+            self._show_bucket(bucket, False)
+        for bucket in in_view - shown:
+            self._show_bucket(bucket, True)
+
+        table = self.ship_table
+        ships_in_view = set(table.ships[k] for k in table.in_rect(
+                                int(x // CELL_WIDTH), int(y // CELL_WIDTH),
+                                int((x + w) // CELL_WIDTH) + 1,
+                                int((y + h) // CELL_WIDTH) + 1).tolist())
+        shown = self.ships_in_view
+        if shown is None:
+            shown = set(table.ships)
+        for ship in shown - ships_in_view:
+            if ship.are_actions_running():
+                ships_in_view.add(ship)
+            else:
+                ship.visible = False
+        for ship in ships_in_view - shown:
+            ship.visible = True
+        self.ships_in_view = ships_in_view
+
+    def sprite_bucket(self, x, y):
+        "Returns the bucket of the sprites of the cell (x, y)."
+        return x // self.sprite_bucket_size, y // self.sprite_bucket_size
+
+    def _show_bucket(self, bucket, visible):
+        "Show or hide the sprites of the bucket, and animate or freeze the asteroids."
+        batch = self.sprite_buckets.get(bucket)
+        if batch is None:
+            return
+        batch.visible = visible
+        size, asteroids = self.sprite_bucket_size, self.entities['asteroids']
+        for i in range(bucket[0] * size, (bucket[0] + 1) * size):
+            for j in range(bucket[1] * size, (bucket[1] + 1) * size):
+                asteroid = asteroids.get((i, j))
+                if asteroid is None:
+                    continue
+                self._set_animated(asteroid, visible)
+
+    def _add_sprite(self, x, y, sprite):
+        "Add the sprite of the cell (x, y) to the batch of its bucket and return it."
+        bucket = self.sprite_bucket(x, y)
+        batch = self.sprite_buckets.get(bucket)
+        if batch is None:
+            batch = self.sprite_buckets[bucket] = cocos.batch.BatchNode()
+            batch.visible = self.buckets_in_view is None or bucket in self.buckets_in_view
+            self.sprite_layer.add(batch)
+        batch.add(sprite)
+        return batch
+
+    def _remove_sprite(self, x, y, sprite):
+        """
+        Remove the sprite of the cell (x, y) from the batch of its bucket,
+        and the batch once it is empty.
+        """
+        bucket = self.sprite_bucket(x, y)
+        batch = self.sprite_buckets[bucket]
+        batch.remove(sprite)
+        if not batch.children:
+            self.sprite_layer.remove(batch)
+            del self.sprite_buckets[bucket]
+
+    def show_chunks(self, x, y, w, h):
+        "Create the sprites of the chunks in view in the given area in pixels."
+        i0, j0 = max(int(x // CELL_WIDTH), 0), max(int(y // CELL_WIDTH), 0)
+        i1 = min(int((x + w) // CELL_WIDTH), self.col - 1)
+        j1 = min(int((y + h) // CELL_WIDTH), self.row - 1)
+        (left, bottom), (right, top) = (self.terrain.chunk_of(i0, j0),
+                                        self.terrain.chunk_of(i1, j1))
+        chunks = [(ci, cj) for ci in range(left, right + 1)
+                  for cj in range(bottom, top + 1)]
+        # The chunks in view are marked as used before showing the new ones,
+        # so only the chunks out of view get evicted.
+        self.shown_chunks.maxsize = max(self.shown_chunks.maxsize, len(chunks))
+        new_chunks = [chunk for chunk in chunks if not self.shown_chunks.get(chunk)]
+        for chunk in new_chunks:
+            self._show_chunk(chunk)
+            self.shown_chunks.put(chunk, True)
+
+    def _show_chunk(self, chunk):
+        """
+        Create the sprites of the asteroids and difficult terrains of the
+        chunk, and the quads of its cells with their overlays painted.
+        """
+        box = left, bottom, right, top = self.terrain.box(chunk)
+        rasters = self.terrain.get_chunk(chunk)
+        for x, y in zip(*[a.tolist() for a in np.nonzero(rasters['obstacle'])]):
+            self._create_asteroid(left + x, bottom + y)
+        for x, y in zip(*[a.tolist() for a in np.nonzero(rasters['diff_terrain'])]):
+            self._create_diff_terrain(left + x, bottom + y)
+        self._add_cell_quads(chunk, box)
+        painted = collections.defaultdict(list)
+        for (i, j), name in self.painted.items():
+            if left <= i < right and bottom <= j < top:
+                painted[name].append((i, j))
+        for name, cells in painted.items():
+            self.highlight_cells(cells, OVERLAY_COLORS.get(name, CLEAR_CELL))
+
+    def _hide_chunk(self, chunk, shown):
+        "Remove the sprites and the quads of the chunk."
+        self.cell_quads.pop(chunk).delete()
+        del self.cell_colors[chunk]
+        self.colors_changed.discard(chunk)
+        left, bottom, right, top = self.terrain.box(chunk)
+        for name in ('asteroids', 'diff_terrain'):
+            sprites = self.entities[name]
+            for cell in [(i, j) for i in range(left, right) for j in range(bottom, top)]:
+                sprite = sprites.pop(cell, None)
+                if sprite is not None:
+                    self._remove_sprite(cell[0], cell[1], sprite)
+                    if name == 'asteroids':
+                        self._set_animated(sprite, False)
+
+    def _set_animated(self, asteroid, animated):
+        "Start or stop advancing the frames of the asteroid."
+        if animated:
+            asteroid.animation.add(asteroid)
+        else:
+            asteroid.animation.discard(asteroid)
+
+    def animate_asteroids(self, dt):
+        """
+        Called every frame to advance the frames of the animated asteroids,
+        all the asteroids of an animation at once.
+        """
+        for anim in self.asteroid_anims:
+            elapsed = self.animation_clocks[anim] + dt
+            steps = int(elapsed // anim.duration)
+            self.animation_clocks[anim] = elapsed - steps * anim.duration
+            if steps:
+                anim.advance(steps)
+
     def step(self, dt):
         "Called every frame to check if buttons were pressed and move the map."
         buttons = self.buttons
@@ -182,19 +576,78 @@ class GridLayer(cocos.layer.ScrollableLayer):
         the coords above the defined threshold in the parameters.
         Returns: set of tuples {(i,j), ...}
         """
-        noise = np.zeros(shape=(self.col, self.row))
-        for x, y in np.ndindex(self.col, self.row):
-            v = simplexnoise.scaled_octave_noise_2d(
-                params['octave'],
-                params['persistance'],
-                params['freq'],
-                0, 255,
-                x + params['x_off'],
-                y + params['y_off'])
-            c = v - params['sparsity']
-            if c<0: c = 0
-            noise[x][y] = 255 - (math.pow(params['density'], c) * 255)
-        return set(zip(*np.where(noise> 0.)))
+        mask, = terrain.generate_masks(self.col, self.row, [params])
+        return self.from_mask_to_cells(mask)
+
+    def from_cells_to_mask(self, cells):
+        "Returns a col x row boolean array set for the given cells (i, j)."
+        mask = np.zeros((self.col, self.row), dtype=bool)
+        if cells:
+            mask[tuple(np.array(list(cells)).T)] = True
+        return mask
+
+    def from_mask_to_cells(self, mask):
+        "Returns the set of the cells (i, j) set in a col x row boolean array."
+        return set(zip(*[a.tolist() for a in np.nonzero(mask)]))
+
+    def _create_asteroid(self, x, y):
+        "Create an animated asteroid sprite at cell (x, y)"
+        anim = self.asteroid_anims[randint(0, len(self.asteroid_anims) - 1)]
+        asteroid = entity.Asteroid(anim, position=self.from_grid_to_pixel(x,y),
+                                                     rotation = uniform(0, 360))
+        self._set_animated(asteroid, self._add_sprite(x, y, asteroid).visible)
+        self.entities['asteroids'][(x, y)] = asteroid
+
+    def _create_diff_terrain(self, x, y):
+        "Create a difficult terrain sprite at cell (x, y)"
+        diff_terrain = entity.DifficultTerrain(choice(self.nebula_grid),
+                        position=self.from_grid_to_pixel(x,y))
+        self._add_sprite(x, y, diff_terrain)
+        self.entities['diff_terrain'][(x, y)] = diff_terrain
+
+    def get_flags(self, i, j):
+        "Returns the bit flags of the occupancy raster for the cell (i, j)."
+        return int(self.occupancy[i + j * self.col])
+
+    def has_asteroid(self, i, j):
+        """
+        Is there an asteroid in the cell (i, j)? With chunks, the cell can be
+        out of view and have no sprite.
+        """
+        return bool(self.get_flags(i, j) & ASTEROID)
+
+    def _set_ship_flags(self, ship, i, j):
+        "Mark the cell (i, j) as occupied by the ship in the occupancy raster."
+        cell = i + j * self.col
+        owner = self.ship_table.owner_id(ship.player) << PLAYER_SHIFT & PLAYER_BITS
+        self.occupancy[cell] = self.occupancy[cell] & (ASTEROID | NEBULA) | SHIP | owner
+
+    def _clear_ship_flags(self, i, j):
+        "Mark the cell (i, j) as free of ship in the occupancy raster."
+        cell = i + j * self.col
+        self.occupancy[cell] = self.occupancy[cell] & (ASTEROID | NEBULA)
+
+    def add_asteroid(self, i, j):
+        "Spawn an asteroid in the cell (i, j) during the battle."
+        if self.has_asteroid(i, j):
+            return
+        if self.terrain is None or self.terrain.chunk_of(i, j) in self.shown_chunks:
+            self._create_asteroid(i, j)
+        self.pathfinder.add_obstacle(i, j)
+        self.occupancy[i + j * self.col] |= ASTEROID
+        self.version += 1
+
+    def remove_asteroid(self, i, j):
+        "Remove the asteroid in the cell (i, j), for instance when it is destroyed."
+        if not self.has_asteroid(i, j):
+            return
+        asteroid = self.entities['asteroids'].pop((i, j), None)
+        if asteroid is not None:
+            self._remove_sprite(i, j, asteroid)
+            self._set_animated(asteroid, False)
+        self.pathfinder.remove_obstacle(i, j)
+        self.occupancy[i + j * self.col] &= ~np.uint8(ASTEROID)
+        self.version += 1
 
     def from_pixel_to_grid(self, position):
         "Compute the cell coords from pixel coords"
@@ -227,9 +680,9 @@ class GridLayer(cocos.layer.ScrollableLayer):
             return
 
         i0, j0 = self.from_pixel_to_grid(sprite.position)
-        self.clear_cell(i0, j0)
+        self.clear_overlays([(i0, j0)])
         # Reconstruct the path
-        path = self.dist_mat.reconstruct_path(i0, j0, i, j, self.battle.predecessor)
+        path = self.pathfinder.reconstruct_path(i0, j0, i, j, self.battle.predecessor)
 
         # Initialize the move and rotate with an empty action
         move = rotate = InstantAction()
@@ -251,8 +704,17 @@ class GridLayer(cocos.layer.ScrollableLayer):
         move = move + end_of_move
         sprite.do(move)
         sprite.do(rotate)
+        # The ship is drawn while it moves, see cull_sprites
+        sprite.visible = True
+        if self.ships_in_view is not None:
+            self.ships_in_view.add(sprite)
         # Update the position in entities['ships']
         self.entities['ships'][(i, j)] = self.entities['ships'].pop( (i0, j0) )
+        self.ship_table.move(sprite, i, j)
+        self._clear_ship_flags(i0, j0)
+        self._set_ship_flags(sprite, i, j)
+        self.visibility.update(sprite, i, j)
+        self.version += 1
 
     def laser(self, pos_from, pos_to):
         "Display a laser beam on the grid."
@@ -282,28 +744,103 @@ class GridLayer(cocos.layer.ScrollableLayer):
         return math.hypot((i0-i1), (j0-j1))
 
     def clear_los(self, posA, posB):
-        "Check if both objects have a clear line of sight"
+        """
+        Check if both objects have a clear line of sight. The asteroids are
+        looked up in the line of sight index, so only the other ships are
+        checked along the line, in the occupancy raster.
+        """
         i0, j0 = posA
         i1, j1 = posB
-        los = library.get_line(i0, j0, i1, j1)
-        #other_ships = {pos:ship for pos, ship in self.entities['ships'].iteritems()
-                        #if (ship is not objA and ship is not objB)}
-        for cell in los:
-            if cell in self.entities['asteroids'] or \
-                cell in self.entities['ships'] and \
-                cell != (i0, j0) and cell != (i1, j1):
-                return False
+        if self.line_of_sight.is_hidden(posA, posB):
+            return False
+        if len(self.ship_table):
+            occupancy, col = self.occupancy, self.col
+            for i, j in self.line_of_sight.get_line(posA, posB):
+                if (occupancy[i + j * col] & SHIP and (i, j) != (i0, j0)
+                        and (i, j) != (i1, j1)):
+                    return False
         return True
 
+    def clear_los_many(self, posA, cells):
+        """
+        Same as clear_los from posA to each cell (i, j) of the cells array.
+        All the lines are drawn at once and their cells checked in the
+        occupancy raster. Returns a boolean array.
+        """
+        if not len(cells):
+            return np.zeros(0, dtype=bool)
+        x, y, starts = library.get_lines(posA[0], posA[1], cells[:, 0], cells[:, 1])
+        flags = self.occupancy[x + y * self.col]
+        # The ships on both ends do not block
+        ends = np.zeros(len(x), dtype=bool)
+        ends[starts[:-1]] = ends[starts[1:] - 1] = True
+        blocked = (flags & ASTEROID).astype(bool) | (flags & SHIP).astype(bool) & ~ends
+        return ~np.logical_or.reduceat(blocked, starts[:-1])
+
+    def _without_ships(self, cells):
+        "Returns the list of cells (i, j) without a ship."
+        if not cells or not len(self.ship_table):
+            return list(cells)
+        coords = np.array(cells).reshape(-1, 2)
+        free = (self.occupancy[coords[:, 0] + coords[:, 1] * self.col] & SHIP) == 0
+        return [cell for cell, is_free in zip(cells, free.tolist()) if is_free]
+
     def get_reachable_cells(self, ship):
         """
         Forward this to the distance matrix. Remove any other ships from
         reachable cells so we can move through ships but not stop on another one.
+        Results are cached until the board changes, so they must not be modified.
         """
         i, j = self.from_pixel_to_grid(ship.position)
-        r_cells, predecessor = self.dist_mat.get_reachable_cells(i, j, ship.speed)
-        r_cells = [cell for cell in r_cells if cell not in self.entities['ships']]
-        return r_cells, predecessor
+        key = (i, j, ship.speed, self.version)
+        result = self.reachable_cache.get(key)
+        if result is None:
+            r_cells, predecessor = self.pathfinder.get_reachable_cells(i, j, ship.speed)
+            r_cells = self._without_ships(r_cells)
+            result = r_cells, predecessor
+            self.reachable_cache.put(key, result)
+        return result
+
+    def get_reachable_cells_many(self, ships):
+        """
+        Same as get_reachable_cells for a whole fleet. The ships missing from
+        the cache are searched together, in a few calls to dijkstra.
+        Returns a list of (reachable cells, predecessor) in the order of ships.
+        """
+        keys = [self.from_pixel_to_grid(ship.position) + (ship.speed, self.version)
+                for ship in ships]
+        results = [self.reachable_cache.get(key) for key in keys]
+        missing = [k for k, result in enumerate(results) if result is None]
+        searched = self.pathfinder.get_reachable_cells_many(
+                        [keys[k][:2] for k in missing], [keys[k][2] for k in missing])
+        for k, (r_cells, predecessor) in zip(missing, searched):
+            r_cells = self._without_ships(r_cells)
+            results[k] = r_cells, predecessor
+            self.reachable_cache.put(keys[k], results[k])
+        return results
+
+    def find_path(self, start, goal):
+        """
+        Shortest path between two cells, whatever the distance. Returns the
+        list of cells to go through, goal included, or None if unreachable.
+        With clusters, the path is near shortest but much faster to get.
+        """
+        if self.hierarchy is not None:
+            return self.hierarchy.find_path(start, goal)
+        return self.pathfinder.find_path(start, goal)
+
+    def get_distance_field(self, targets):
+        """
+        Returns the DistanceField towards the list of target cells (i, j).
+        Fields are cached until the board changes, so every ship moving
+        towards the same targets shares the same field.
+        """
+        key = (frozenset(targets), self.version)
+        field = self.field_cache.get(key)
+        if field is None:
+            field = self.pathfinder.get_distance_field(targets)
+            self.field_cache.put(key, field)
+        return field
 
     def get_random_free_cells(self, side):
         "Returns a generator giving cells without obstacle in an area close to a border"
@@ -319,7 +856,9 @@ class GridLayer(cocos.layer.ScrollableLayer):
         # Bottom
         else:
             left, right, top, bottom = self.col/3, self.col*2/3, 3, 0
-        coords = [(x, y) for x in range(left, right) for y in range(bottom, top) if (x, y) not in self.entities['asteroids']]
+        x, y = [a.ravel() for a in np.mgrid[left:right, bottom:top]]
+        free = (self.occupancy[x + y * self.col] & ASTEROID) == 0
+        coords = list(zip(x[free].tolist(), y[free].tolist()))
         shuffle(coords)
         return coords
 
@@ -331,40 +870,135 @@ class GridLayer(cocos.layer.ScrollableLayer):
     def get_entity(self, x, y):
         "Return the entity at position x, y"
         i, j = self.from_pixel_to_grid( (x, y) )
+        if i is None or not self.get_flags(i, j) & SHIP:
+            return None
         return self.entities['ships'].get( (i, j) )
 
     def get_targets(self, ship, position=None):
-        "Returns the list of all ennemy ships in range"
-        current_player = ship.player
+        """
+        Returns the list of all ennemy ships in range. The ships in range are
+        found with the spatial index of the ship table, then their lines of
+        sight are checked at once.
+        """
         if position is None:
             position = self.from_pixel_to_grid(ship.position)
-        targets = []
-        for entity in self.entities['ships'].itervalues():
-            target_pos = self.from_pixel_to_grid(entity.position)
-            if entity.player != current_player \
-                    and self.distance(position, target_pos) <= ship.weapon.range \
-                    and self.clear_los(position, target_pos):
-                targets.append(entity)
-        return targets
+        table = self.ship_table
+        cells = table.cells
+        candidates = table.in_radius(position[0], position[1], ship.weapon.range,
+                                     enemies_of=ship.player)
+        if not len(candidates):
+            return []
+        visible = self.line_of_sight.are_visible(position, cells[candidates], cells)
+        far = np.flatnonzero(visible == -1)
+        if len(far):
+            # Too far for the index
+            visible[far] = self.clear_los_many(position, cells[candidates[far]])
+        return [table.ships[k] for k in candidates[visible == 1].tolist()]
+
+    def _add_cell_quads(self, key, box):
+        """
+        Create the quads of the cells of the box (left, bottom, right, top),
+        right and top excluded, in one vertex list ordered by cell number.
+        """
+        left, bottom, right, top = box
+        width, size = right - left, (right - left) * (top - bottom)
+        j, i = np.divmod(np.arange(size), width)
+        left, bottom = (i + left) * CELL_WIDTH, (j + bottom) * CELL_WIDTH
+        right, top = left + CELL_WIDTH, bottom + CELL_WIDTH
+        vertices = np.column_stack((left, bottom, left, top, right, top, right, bottom))
+        quads = self.grid_batch.add(4 * size, GL_QUADS,
+                            pyglet.graphics.Group(parent=self.quads_group),
+                            ('v2f', vertices.ravel().tolist()),
+                            ('c4B', (128, 128, 128, 0) * 4 * size))
+        self.cell_quads[key] = quads
+        self.cell_colors[key] = np.ctypeslib.as_array(quads.colors).reshape(size, 4, 4)
+
+    def _color_quads(self, i, j, color):
+        """
+        Set the color of the quads of the cells (i, j), given as arrays. The
+        cells of the chunks not shown have no quads and are skipped.
+        """
+        if self.terrain is None:
+            self.cell_colors[None][i + j * self.col] = color
+            self.colors_changed.add(None)
+            return
+        ci, cj = self.terrain.chunk_of(i, j)
+        for chunk in set(zip(ci.tolist(), cj.tolist())):
+            colors = self.cell_colors.get(chunk)
+            if colors is None:
+                continue
+            left, bottom, right, _ = self.terrain.box(chunk)
+            inside = (ci == chunk[0]) & (cj == chunk[1])
+            colors[i[inside] - left + (j[inside] - bottom) * (right - left)] = color
+            self.colors_changed.add(chunk)
 
     def highlight_cell(self, i, j, color):
         "Highlight the cell in the given color."
-        self.squares[i][j].colors = color * 4
+        self._color_quads(np.array([i]), np.array([j]), color)
 
     def highlight_cells(self, cells, color):
         """Highlight the cells in the list in the given color."""
-        for i, j in cells:
-            self.highlight_cell(i, j, color)
+        coords = np.array(list(cells), dtype=int).reshape(-1, 2)
+        self._color_quads(coords[:, 0], coords[:, 1], color)
+
+    def highlight_mask(self, mask, color):
+        "Highlight the cells set in a col x row boolean array in the given color."
+        i, j = np.nonzero(mask)
+        self._color_quads(i, j, color)
 
     def highlight_player(self, player):
         """Highlight the player' ships"""
-        self.highlight_ships(player.fleet, PLAYER_TURN)
+        self.set_overlay('player turn', self.get_ships_cells(player.fleet))
 
-    def highlight_ships(self, ships, color):
-        cells = []
-        for ship in ships:
-            cells.append(self.from_pixel_to_grid(ship.position))
-        self.highlight_cells(cells, color)
+    def get_ships_cells(self, ships):
+        "Returns the list of the cells of the ships."
+        return [self.from_pixel_to_grid(ship.position) for ship in ships]
+
+    def set_overlay(self, name, cells):
+        """
+        Set the cells (i, j) of the highlight overlay name, see OVERLAYS.
+        The cells are painted by the next draw, see paint_overlays.
+        """
+        cells = set(cells)
+        self.dirty_cells |= self.overlays[name] ^ cells
+        self.overlays[name] = cells
+
+    def add_overlay(self, name, cells):
+        "Add the cells (i, j) to the highlight overlay name."
+        self.set_overlay(name, self.overlays[name].union(cells))
+
+    def remove_overlay(self, name, cells):
+        "Remove the cells (i, j) from the highlight overlay name."
+        self.set_overlay(name, self.overlays[name].difference(cells))
+
+    def clear_overlays(self, cells):
+        "Remove the cells (i, j) from all the highlight overlays."
+        cells = set(cells)
+        for overlay in self.overlays.values():
+            overlay -= cells
+        self.dirty_cells |= cells
+
+    def paint_overlays(self):
+        """
+        Paint the changed cells whose overlay of highest priority is not the
+        one painted, with one write per color. A cell cleared and set again
+        since the last paint is not written.
+        """
+        repaint = collections.defaultdict(list)
+        cells, self.dirty_cells = self.dirty_cells, set()
+        for cell in cells:
+            top = None
+            for name, _ in OVERLAYS:
+                if cell in self.overlays[name]:
+                    top = name
+            if self.painted.get(cell) != top:
+                repaint[top].append(cell)
+                if top is None:
+                    del self.painted[cell]
+                else:
+                    self.painted[cell] = top
+        for name, cells in repaint.items():
+            self.highlight_cells(cells, OVERLAY_COLORS.get(name, CLEAR_CELL))
 
     def clear_cell(self, i, j):
         """Remove any highlight from the cell"""
@@ -376,7 +1010,7 @@ class GridLayer(cocos.layer.ScrollableLayer):
 
     def clear_ships_highlight(self, ships):
         """Remove any highlight from the ships"""
-        self.highlight_ships(ships, CLEAR_CELL)
+        self.clear_overlays(self.get_ships_cells(ships))
 
     def on_key_press(self, symbol, modifiers):
         # Check for key pressed in our key bindings
@@ -429,10 +1063,23 @@ class GridLayer(cocos.layer.ScrollableLayer):
         for a, ship in enumerate(player.fleet):
             i, j = starting_cells[a]
             self.entities['ships'][(i, j)] = ship
+            self.ship_table.add(ship, i, j)
+            self._set_ship_flags(ship, i, j)
+            self.visibility.update(ship, i, j)
+            self.version += 1
             x, y = self.from_grid_to_pixel(i,j)
             ship.position = (x, y)
             ship.rotation = orientation[side]
             self.add(ship)
+            if self.ships_in_view is not None:
+                self.ships_in_view.add(ship)
+
+    def update_view_ranges(self):
+        """
+        Called when a weapon of a ship is changed or jams: the fog of war
+        follows the new ranges.
+        """
+        self.visibility.update_ranges()
 
     def remove(self, entity):
         "Removes the entity both from the Layer and from the dict entities"
@@ -440,91 +1087,428 @@ class GridLayer(cocos.layer.ScrollableLayer):
         for grid_pos, ship in self.entities['ships'].items():
             if ship is entity:
                 del self.entities['ships'][grid_pos]
+                self.ship_table.remove(ship)
+                self._clear_ship_flags(*grid_pos)
+                self.visibility.remove(ship)
+                self.clear_overlays([grid_pos])
+                if self.ships_in_view is not None:
+                    self.ships_in_view.discard(ship)
+                self.version += 1
 
 
 
-class DistanceMatrix(object):
+class TerrainChunks(object):
     """
-    Distance matrix where we can add obstacles.
-    Can also be used to recontruct a shortest path, giving the predecessor matrix.
+    Terrain of a battlemap split into chunks of size x size cells, identified
+    by their coords (ci, cj). The terrain of a chunk is generated from the
+    noise the first time one of its cells is used. Only the chunks used last
+    are kept in memory, the others are generated again when needed. Changes
+    made to the terrain are kept aside so they survive the unloading.
+
+    The obstacle and cost_factor rasters are indexed by cell number like the
+    ones of GridGraph, so they can be given to a matrix free pathfinder.
+    """
+    # dtype of each raster of a chunk
+    RASTERS = {'obstacle': bool, 'cost_factor': float, 'diff_terrain': bool,
+               'occupancy': np.uint8}
+
+    def __init__(self, row, col, map_kwargs, size=32, max_chunks=LOADED_CHUNKS):
+        self.row, self.col, self.size = row, col, size
+        self.obstacle_params = map_kwargs['obstacle']
+        self.diff_terrain_params = map_kwargs['difficult terrain']
+        # Rasters by chunk coords
+        self.chunks = library.LRUCache(max_chunks)
+        # Changes by chunk coords, as {(raster name, x, y): value} where
+        # (x, y) are the coords of the cell in the chunk. A cell set back to
+        # its generated value is dropped, so the ships moving around do not
+        # grow it.
+        self.edits = {}
+        self.obstacle = ChunkedRaster(self, 'obstacle')
+        self.cost_factor = ChunkedRaster(self, 'cost_factor')
+        self.occupancy = ChunkedRaster(self, 'occupancy')
+
+    def chunk_of(self, i, j):
+        "Returns the coords of the chunk of the cell (i, j)."
+        return i // self.size, j // self.size
+
+    def box(self, chunk):
+        """
+        Returns the cells of the chunk as (left, bottom, right, top), right
+        and top excluded.
+        """
+        ci, cj = chunk
+        return (ci * self.size, cj * self.size,
+                min((ci + 1) * self.size, self.col),
+                min((cj + 1) * self.size, self.row))
+
+    def get_chunk(self, chunk):
+        """
+        Returns the rasters of the chunk as a dict {name: array}, generating
+        them if needed. The arrays are indexed by the coords of the cells in
+        the chunk.
+        """
+        rasters = self.chunks.get(chunk)
+        if rasters is None:
+            rasters = self._generate(chunk)
+            self.chunks.put(chunk, rasters)
+        return rasters
+
+    def _noise_rasters(self, x, y):
+        "Returns the rasters generated from the noise for the cells (x, y) as a dict."
+        # No obstacle on the difficult terrains, like GridLayer
+        diff_terrain = terrain.noise_mask(self.diff_terrain_params, x, y)
+        obstacle = terrain.noise_mask(self.obstacle_params, x, y) & ~diff_terrain
+        return {
+            'obstacle': obstacle,
+            'cost_factor': np.where(diff_terrain,
+                                    self.diff_terrain_params['cost factor'], 1.),
+            'diff_terrain': diff_terrain,
+            'occupancy': (obstacle * ASTEROID | diff_terrain * NEBULA).astype(np.uint8)}
+
+    def _generate(self, chunk):
+        "Generate the rasters of the chunk, with the changes made to it."
+        left, bottom, right, top = self.box(chunk)
+        rasters = self._noise_rasters(*np.mgrid[left:right, bottom:top])
+        for (name, x, y), value in self.edits.get(chunk, {}).items():
+            rasters[name][x, y] = value
+        return rasters
+
+    def get_values(self, name, cells):
+        "Returns the values of the raster name for the cell numbers cells."
+        if np.ndim(cells) == 0:
+            j, i = divmod(int(cells), self.col)
+            return self.get_chunk(self.chunk_of(i, j))[name][i % self.size, j % self.size]
+        cells = np.asarray(cells)
+        values = np.empty(cells.shape, dtype=self.RASTERS[name])
+        j, i = np.divmod(cells, self.col)
+        ci, cj = self.chunk_of(i, j)
+        # The cells are grouped by chunk
+        keys = (ci * (self.row // self.size + 1) + cj).ravel()
+        order = np.argsort(keys, kind='mergesort')
+        starts = np.flatnonzero(np.diff(keys[order])) + 1
+        for group in np.split(order, starts):
+            if not len(group):
+                continue
+            chunk = ci.flat[group[0]], cj.flat[group[0]]
+            raster = self.get_chunk(chunk)[name]
+            values.flat[group] = raster[i.flat[group] % self.size,
+                                        j.flat[group] % self.size]
+        return values
+
+    def set_values(self, name, cells, value):
+        """
+        Set the raster name to value for the cell numbers cells. Only the
+        cells which differ from the generated terrain are kept in edits.
+        """
+        cells = np.atleast_1d(cells)
+        j, i = np.divmod(cells, self.col)
+        generated = self._noise_rasters(i, j)[name]
+        for cell, original in zip(cells.tolist(), generated.tolist()):
+            j, i = divmod(cell, self.col)
+            chunk, x, y = self.chunk_of(i, j), i % self.size, j % self.size
+            edits = self.edits.setdefault(chunk, {})
+            if value == original:
+                edits.pop((name, x, y), None)
+                if not edits:
+                    del self.edits[chunk]
+            else:
+                edits[(name, x, y)] = value
+            self.get_chunk(chunk)[name][x, y] = value
+
+
+class ChunkedRaster(object):
+    """
+    A raster of TerrainChunks, which can be indexed and set by cell numbers
+    like a numpy array.
+    """
+    def __init__(self, terrain, name):
+        self.terrain, self.name = terrain, name
+
+    def __getitem__(self, cells):
+        return self.terrain.get_values(self.name, cells)
+
+    def __setitem__(self, cells, value):
+        self.terrain.set_values(self.name, cells, value)
+
+
+class ShipTable(object):
+    """
+    The ships of the grid with their cells and owners in numpy arrays, so
+    queries over all the ships are vectorized. The kth ship of the list
+    ships is in the cell cells[k] and belongs to the player of id owners[k].
+
+    The ships are also indexed by buckets of bucket_size x bucket_size
+    cells, so the radius, rectangle and nearest queries only look at the
+    ships of the buckets around. Those queries return the indices of the
+    ships in the arrays, in increasing order for the radius and rectangle
+    ones. With enemies_of, only the ships of the other players are kept.
+    """
+    def __init__(self, bucket_size=SHIP_BUCKET_SIZE):
+        self.ships = []
+        self.cells = np.zeros((0, 2), dtype=int)
+        self.owners = np.zeros(0, dtype=int)
+        # Index of each ship in the arrays
+        self.indices = {}
+        # Ids of the players by player
+        self.owner_ids = {}
+        self.bucket_size = bucket_size
+        # The ships by bucket (x, y). The cell (i, j) is in the bucket
+        # (i // bucket_size, j // bucket_size).
+        self.buckets = collections.defaultdict(set)
+
+    def owner_id(self, player):
+        "Returns the id of the player in owners."
+        return self.owner_ids.setdefault(player, len(self.owner_ids))
+
+    def bucket(self, i, j):
+        "Returns the bucket of the cell (i, j)"
+        return i // self.bucket_size, j // self.bucket_size
+
+    def add(self, ship, i, j):
+        "Add the ship in cell (i, j)"
+        self.indices[ship] = len(self.ships)
+        self.ships.append(ship)
+        self.cells = np.concatenate((self.cells, [(i, j)]))
+        self.owners = np.append(self.owners, self.owner_id(ship.player))
+        self.buckets[self.bucket(i, j)].add(ship)
+
+    def move(self, ship, i, j):
+        "Move the ship to the cell (i, j)"
+        k = self.indices[ship]
+        self._remove_from_bucket(ship, *self.cells[k])
+        self.cells[k] = i, j
+        self.buckets[self.bucket(i, j)].add(ship)
+
+    def remove(self, ship):
+        "Remove the ship. The last ship takes its place in the arrays."
+        k, last = self.indices.pop(ship), len(self.ships) - 1
+        self._remove_from_bucket(ship, *self.cells[k])
+        if k != last:
+            self.indices[self.ships[last]] = k
+        self.ships[k] = self.ships[last]
+        self.cells[k] = self.cells[last]
+        self.owners[k] = self.owners[last]
+        del self.ships[last]
+        self.cells, self.owners = self.cells[:last], self.owners[:last]
+
+    def _remove_from_bucket(self, ship, i, j):
+        "Remove the ship from the bucket of the cell (i, j)"
+        bucket = self.bucket(i, j)
+        self.buckets[bucket].discard(ship)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def _indices_in_buckets(self, left, bottom, right, top, enemies_of=None):
+        """
+        Returns the sorted indices of the ships in the buckets holding the
+        cells from (left, bottom) to (right, top) included.
+        """
+        (x0, y0), (x1, y1) = self.bucket(left, bottom), self.bucket(right, top)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.buckets):
+            # Fewer buckets with ships than buckets in the area
+            ships = [ship for (x, y), bucket in self.buckets.items()
+                     if x0 <= x <= x1 and y0 <= y <= y1 for ship in bucket]
+        else:
+            ships = [ship for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                     for ship in self.buckets.get((x, y), ())]
+        indices = np.sort(np.array([self.indices[ship] for ship in ships], dtype=int))
+        if enemies_of is not None:
+            indices = indices[self.owners[indices] != self.owner_id(enemies_of)]
+        return indices
+
+    def in_radius(self, i, j, radius, enemies_of=None):
+        "Returns the indices of the ships at a distance of (i, j) up to radius."
+        r = int(math.floor(radius))
+        indices = self._indices_in_buckets(i - r, j - r, i + r, j + r, enemies_of)
+        cells = self.cells[indices]
+        return indices[np.hypot(cells[:, 0] - i, cells[:, 1] - j) <= radius]
+
+    def in_rect(self, left, bottom, right, top, enemies_of=None):
+        """
+        Returns the indices of the ships in the box (left, bottom, right,
+        top), right and top excluded.
+        """
+        indices = self._indices_in_buckets(left, bottom, right - 1, top - 1, enemies_of)
+        cells = self.cells[indices]
+        inside = ((cells[:, 0] >= left) & (cells[:, 0] < right) &
+                  (cells[:, 1] >= bottom) & (cells[:, 1] < top))
+        return indices[inside]
+
+    def nearest(self, i, j, k=1, enemies_of=None):
+        """
+        Returns the indices of the k ships closest to (i, j), from the
+        closest to the furthest. The rings of buckets around the cell are
+        searched until no ship further away can be closer.
+        """
+        size = self.bucket_size
+        x, y = self.bucket(i, j)
+        ring = 0
+        while True:
+            left, bottom = (x - ring) * size, (y - ring) * size
+            right, top = (x + ring + 1) * size, (y + ring + 1) * size
+            indices = self._indices_in_buckets(left, bottom, right - 1, top - 1,
+                                               enemies_of)
+            cells = self.cells[indices]
+            distance = np.hypot(cells[:, 0] - i, cells[:, 1] - j)
+            order = np.argsort(distance, kind='mergesort')[:k]
+            # A ship out of the searched buckets is at least that far
+            bound = min(i - left + 1, right - i, j - bottom + 1, top - j)
+            found = len(order) == k and (not k or distance[order[-1]] <= bound)
+            if found or all(abs(bx - x) <= ring and abs(by - y) <= ring
+                            for bx, by in self.buckets):
+                return indices[order]
+            ring += 1
+
+    def __len__(self):
+        return len(self.ships)
+
+
+class GridGraph(object):
+    """
+    Base class of the pathfinding backends. It holds the terrain as one value
+    per cell: is it an obstacle and what is its cost factor (1 for a normal
+    cell). Moving straight costs 1 and moving diagonally sqrt(2), multiplied
+    by the cost factor of the cell we move into.
+    Subclasses give the neighbours of a cell through _neighbours.
     """
-    def __init__(self, row, col):
+    # Number of origins searched together in a single dijkstra call by
+    # get_reachable_cells_many. Its result grows with the square of it.
+    CHUNK = 16
+
+    def __init__(self, row, col, obstacles=(), cf=1., diff_terrains=()):
+        """
+        Set up a row x col grid with its obstacles and its difficult
+        terrains (with cost factor cf).
+        """
+        self._init_grid(row, col)
+        self.obstacle = self._cell_mask(obstacles)
+        self.cost_factor = np.ones(self.row * self.col)
+        self.cost_factor[self._cell_mask(diff_terrains)] = cf
+
+    def _init_grid(self, row, col):
+        "Set up what does not depend on the terrain of a row x col grid."
         self.row, self.col = row, col
-        self.dist_mat = lil_matrix((self.row*self.col, self.row*self.col))
-        # Construct distance matrix for an empty grid
-        # cost to the distance matrix. Straight = 1; Diag = sqrt(2)
-        for j in range(self.row):
-            for i in range(self.col):
-                for x_offset in (-1,0,1):
-                    for y_offset in (-1,0,1):
-                        if self.valid_grid(i+x_offset, j+y_offset):
-                            if x_offset and y_offset:
-                                self.dist_mat[ i + j*self.col, (i+x_offset) + (j+y_offset) * self.col] = math.sqrt(2)
-                            elif x_offset or y_offset:
-                                self.dist_mat[i + j*self.col, (i+x_offset) + (j+y_offset) * self.col] = 1
-
-        # And convert this huge matrix to a sparse matrix.
-        self.dist_mat = self.dist_mat.tocsc()
+        # Cell number offset of each neighbour
+        self.offsets = [self.from_coord_to_cell_number(x, y) for x, y in NEIGHBOURS]
+        # Objects with an on_terrain_change(i, j) method, told about every edit
+        self.observers = []
+
+    @classmethod
+    def from_arrays(cls, row, col, arrays):
+        """
+        Returns the graph of a row x col grid from the dict of arrays given
+        by to_arrays, without building it again.
+        The obstacle and cost_factor rasters can also be given as objects
+        indexed like arrays, such as the rasters of TerrainChunks.
+        """
+        graph = cls.__new__(cls)
+        graph._init_grid(row, col)
+        graph._set_arrays(arrays)
+        return graph
+
+    def to_arrays(self):
+        "Returns a dict of the arrays from which from_arrays rebuilds the graph."
+        return {'obstacle': self.obstacle, 'cost_factor': self.cost_factor}
+
+    def _set_arrays(self, arrays):
+        "Set the state of the graph from the arrays given by to_arrays."
+        self.obstacle = arrays['obstacle']
+        self.cost_factor = arrays['cost_factor']
+
+    def _edge_weights(self, src, x_offset, y_offset):
+        """
+        Returns the cost of the edges going from the src cells to their
+        neighbour at (x_offset, y_offset). Blocked edges cost np.inf.
+        """
+        obstacle = self.obstacle
+        dest = src + self.from_coord_to_cell_number(x_offset, y_offset)
+        cost = math.sqrt(2) if x_offset and y_offset else 1.
+        # We cannot move from or into an obstacle.
+        free = ~obstacle[src] & ~obstacle[dest]
+        # Nor cut a corner between two diagonal obstacles. See add_obstacle.
+        if x_offset and y_offset:
+            free &= ~(obstacle[src + x_offset] &
+                      obstacle[src + y_offset * self.col])
+        # Difficult terrains always set the cost of the moves into their cell,
+        # as they used to be applied after the obstacles, but an obstacle
+        # added on them later still blocks the cell.
+        free |= ((self.cost_factor[dest] != 1.) &
+                 ~obstacle[src] & ~obstacle[dest])
+        return np.where(free, cost * self.cost_factor[dest], np.inf)
+
+    def _terrain_changed(self, i, j):
+        "Update the moves around cell (i, j) after an edit and tell the observers."
+        self._update_edges(i, j)
+        for observer in self.observers:
+            observer.on_terrain_change(i, j)
+
+    def _update_edges(self, i, j):
+        "Called when the terrain of cell (i, j) changed."
+        pass
+
+    def _neighbours(self, cell):
+        "Returns a list of (neighbour, cost) we can move to from the cell."
+        raise NotImplementedError
+
+    def _cell_mask(self, cells):
+        "Returns a boolean array, indexed by cell number, set for the given cells."
+        mask = np.zeros(self.row * self.col, dtype=bool)
+        cells = list(cells)
+        if cells:
+            i, j = np.array(cells).T
+            mask[self.from_coord_to_cell_number(i, j)] = True
+        return mask
 
     def valid_grid(self, xo, yo):
-        "Helper function to check if we are in the grid and not in a wall."
-        in_grid = not xo<0 and not yo<0 and xo<self.col and yo<self.row
+        """
+        Helper function to check if we are in the grid and not in a wall.
+        Works on scalars as well as on numpy arrays of coordinates.
+        """
+        in_grid = (xo >= 0) & (yo >= 0) & (xo < self.col) & (yo < self.row)
         return in_grid
 
-    def _add_difficult_terrain(self, cf, i, j):
-        "Add difficult terrain at position i,j. Cost factor is cf"
-        for x_offset in (-1,0,1):
-            for y_offset in (-1,0,1):
-                if self.valid_grid(i+x_offset, j+y_offset):
-                    if x_offset and y_offset:
-                        self.dist_mat[ (i+x_offset) + (j+y_offset) * self.col, i + j*self.col] = cf*math.sqrt(2)
-                    elif x_offset or y_offset:
-                        self.dist_mat[ (i+x_offset) + (j+y_offset) * self.col, i + j*self.col] = cf
+    def set_cost_factor(self, cf, i, j):
+        "Set the cost factor of the cell i,j. Use 1 for a normal cell."
+        self.cost_factor[self.from_coord_to_cell_number(i, j)] = cf
+        self._terrain_changed(i, j)
 
     def add_difficult_terrains(self, cf, diff_terrains):
         "Add list of difficult terrains at position (i,j). Cost factor is cf"
-        self.dist_mat = self.dist_mat.tolil()
         for diff_terrain in diff_terrains:
-            self._add_difficult_terrain(cf, *diff_terrain)
-        self.dist_mat = self.dist_mat.tocsc()
+            self.set_cost_factor(cf, *diff_terrain)
 
     def add_obstacles(self, obstacles):
         "Add obstacles at position (i, j)"
-        # Change the distance matrix to lil format
-        self.dist_mat = self.dist_mat.tolil()
         for obstacle in obstacles:
-            self._add_obstacle(*obstacle)
-        # Update the distance matrix in csc format
-        self.dist_mat = self.dist_mat.tocsc()
-
-    def _add_obstacle(self, i, j):
-        "Add obstacle at position i,j"
-        grid_number = self.from_coord_to_cell_number(i, j)
-
-        # Check if the new obstacle is set at a diagonal from another obstacle.
-        # Example: we add an obstacle at 4 and there was already an obstacle at 8:
-        # -------------
-        # | 6 | 7 | X |
-        # -------------
-        # | 3 | X | 5 |
-        # -------------
-        # | 0 | 1 | 2 |
-        # -------------
-        # Deny movements between 5 and 7.
-        ctc = self.from_coord_to_cell_number
-        for x in (-1, 1):
-            for y in (-1, 1):
-                if self.valid_grid(i+x, j+y) \
-                   and self.dist_mat[grid_number, ctc(i+x, j+y)] == 0:
-                    self.dist_mat[ctc(i, j+y), ctc(i+x, j)] = 0
-                    self.dist_mat[ctc(i+x, j), ctc(i, j+y)] = 0
-
-        # Set to 0 the whole col at grid_num as we cannot move into this position.
-        self.dist_mat[: ,grid_number] = 0
-
-        # Set to 0 the whole row at grid_num as this is an obstacle and we cannot move
-        # from this position.
-        self.dist_mat[grid_number, :] = 0
+            self.add_obstacle(*obstacle)
+
+    def remove_obstacles(self, obstacles):
+        "Remove obstacles at position (i, j)"
+        for obstacle in obstacles:
+            self.remove_obstacle(*obstacle)
+
+    def add_obstacle(self, i, j):
+        """
+        Add obstacle at position i,j
+        We cannot move into or from this position. And if the new obstacle is
+        set at a diagonal from another obstacle, we cannot cut the corner.
+        Example: we add an obstacle at 4 and there was already an obstacle at 8:
+        -------------
+        | 6 | 7 | X |
+        -------------
+        | 3 | X | 5 |
+        -------------
+        | 0 | 1 | 2 |
+        -------------
+        Deny movements between 5 and 7.
+        """
+        self.obstacle[self.from_coord_to_cell_number(i, j)] = True
+        self._terrain_changed(i, j)
+
+    def remove_obstacle(self, i, j):
+        "Remove the obstacle at position i,j"
+        self.obstacle[self.from_coord_to_cell_number(i, j)] = False
+        self._terrain_changed(i, j)
 
     def from_cell_number_to_coord(self, number):
         """
@@ -544,15 +1528,192 @@ class DistanceMatrix(object):
         "See _from_cell_number_to_coord. Does the opposite"
         return i + j * self.col
 
+    def _search(self, origin, dest=None, limit=np.inf, box=None):
+        """
+        Dijkstra search from the origin cell number. It stops expanding once
+        the cost passes limit, or when dest is reached, in which case the
+        octile distance to dest guides the search (A*). With a box
+        (left, bottom, right, top), the search stays inside it.
+        Returns the dict of costs {cell number: cost} of the reached cells
+        and the predecessors {cell number: previous cell number}.
+        """
+        dist, predecessor = {origin: 0.}, {}
+        heap = [(0., 0., origin)]
+        while heap:
+            _, cost, cell = heapq.heappop(heap)
+            if cell == dest:
+                break
+            # Skip outdated entries of cells already reached at a lower cost.
+            if cost > dist[cell]:
+                continue
+            for neighbour, weight in self._neighbours(cell):
+                new_cost = cost + weight
+                if new_cost <= limit and new_cost < dist.get(neighbour, np.inf):
+                    if box is not None and not self.in_box(neighbour, box):
+                        continue
+                    dist[neighbour] = new_cost
+                    predecessor[neighbour] = cell
+                    priority = new_cost
+                    if dest is not None:
+                        priority += self.octile_distance(neighbour, dest)
+                    heapq.heappush(heap, (priority, new_cost, neighbour))
+        return dist, predecessor
+
+    def in_box(self, cell, box):
+        "Check if the cell number is in the box (left, bottom, right, top)"
+        left, bottom, right, top = box
+        i, j = self.from_cell_number_to_coord(cell)
+        return left <= i < right and bottom <= j < top
+
     def get_reachable_cells(self, i, j, speed):
-        "Returns all the cells reachable from (i, j) and the predecessor matrix"
-        origin = self.from_coord_to_cell_number(i, j)
-        dist, predecessor = dijkstra(self.dist_mat, indices=origin, return_predecessors=True)
-        # Only take those where dist is reachable
-        dist = np.argwhere(dist <= speed).flatten()
+        """
+        Returns all the cells reachable from (i, j) and the predecessors.
+        The search stops expanding once the cost passes speed, so only the
+        neighbourhood of (i, j) is explored whatever the size of the map.
+        The predecessors are a dict {cell number: previous cell number} for
+        the reachable cells, see reconstruct_path.
+        """
+        dist, predecessor = self._search(self.from_coord_to_cell_number(i, j),
+                                         limit=speed)
         # And convert it to a list of grid coordinates
-        dist = map(self.from_cell_number_to_coord, dist)
-        return dist, predecessor
+        cells = [self.from_cell_number_to_coord(cell) for cell in sorted(dist)]
+        return cells, predecessor
+
+    def _window_graph(self, boxes):
+        """
+        Build one sparse matrix holding the moves inside each of the boxes
+        (left, bottom, right, top), the boxes being set along its diagonal.
+        Returns the matrix and, for each box, the array of its cell numbers
+        in the order of the matrix.
+        """
+        # For each window: its cells and, repeated for each of its cells, its
+        # first index in the matrix, its bottom left corner and its size.
+        windows, size = [], 0
+        starts, lefts, bottoms, widths, heights = [], [], [], [], []
+        for left, bottom, right, top in boxes:
+            xs, ys = np.arange(left, right), np.arange(bottom, top)
+            window = self.from_coord_to_cell_number(xs, ys[:, np.newaxis]).ravel()
+            windows.append(window)
+            for values, value in ((starts, size), (lefts, left), (bottoms, bottom),
+                                  (widths, right - left), (heights, top - bottom)):
+                values.append(np.full(len(window), value, dtype=int))
+            size += len(window)
+
+        cells = np.concatenate(windows)
+        start, left, bottom = map(np.concatenate, (starts, lefts, bottoms))
+        width, height = map(np.concatenate, (widths, heights))
+        i, j = self.from_cell_number_to_coord(cells)
+        sources, destinations, weights = [], [], []
+        for x_offset, y_offset in NEIGHBOURS:
+            # Coordinates of the neighbours relative to the window
+            x, y = i + x_offset - left, j + y_offset - bottom
+            inside = np.flatnonzero((x >= 0) & (y >= 0) & (x < width) & (y < height))
+            weight = self._edge_weights(cells[inside], x_offset, y_offset)
+            free = weight != np.inf
+            sources.append(inside[free])
+            destinations.append((start + x + y * width)[inside[free]])
+            weights.append(weight[free])
+        graph = csr_matrix((np.concatenate(weights),
+                           (np.concatenate(sources), np.concatenate(destinations))),
+                           shape=(size, size))
+        return graph, windows
+
+    def _matrix(self):
+        "Returns the sparse matrix of the moves on the whole grid."
+        graph, _ = self._window_graph([(0, 0, self.col, self.row)])
+        return graph
+
+    def get_distance_field(self, targets):
+        """
+        Returns the DistanceField towards the list of target cells (i, j).
+        A single dijkstra call from all the targets on the reversed moves
+        gives the cost to the closest target from every cell: an extra node
+        is linked to every target by a zero weight move and the search
+        starts from it.
+        """
+        size = self.col * self.row
+        origins = [self.from_coord_to_cell_number(i, j) for i, j in targets]
+        reversed_moves = self._matrix().T.tocoo()
+        # Sparse graphs keep explicit zeros as moves of zero weight.
+        graph = csr_matrix((np.concatenate((reversed_moves.data, np.zeros(len(origins)))),
+                            (np.concatenate((reversed_moves.row, np.full(len(origins), size))),
+                             np.concatenate((reversed_moves.col, origins)))),
+                           shape=(size + 1, size + 1))
+        dist, next_cell = dijkstra(graph, indices=size, return_predecessors=True)
+        dist, next_cell = dist[:size], next_cell[:size]
+        next_cell[next_cell == size] = -9999
+        return DistanceField(self, dist, next_cell)
+
+    def get_reachable_cells_many(self, origins, speeds):
+        """
+        Batched get_reachable_cells for a list of (i, j) origins and their speeds.
+        As every move costs at least 1, a search never leaves the window of
+        the grid within speed cells of its origin. The windows of CHUNK
+        origins are set along the diagonal of one matrix so a single dijkstra
+        call covers them all.
+        Returns a list of (cells, predecessor) in the order of origins.
+        """
+        results = []
+        for k in range(0, len(origins), self.CHUNK):
+            results.extend(self._reachable_chunk(origins[k:k + self.CHUNK],
+                                                 speeds[k:k + self.CHUNK]))
+        return results
+
+    def _reachable_chunk(self, origins, speeds):
+        "get_reachable_cells_many for a chunk of origins, in one dijkstra call."
+        max_speed = max(speeds)
+        radius = int(max_speed)
+        boxes = [(max(i - radius, 0), max(j - radius, 0),
+                  min(i + radius + 1, self.col), min(j + radius + 1, self.row))
+                 for i, j in origins]
+        graph, windows = self._window_graph(boxes)
+        local_origins, start = [], 0
+        for (i, j), window in zip(origins, windows):
+            local_origins.append(start + np.searchsorted(window,
+                                    self.from_coord_to_cell_number(i, j)))
+            start += len(window)
+
+        dist, predecessor = dijkstra(graph, indices=local_origins,
+                                     return_predecessors=True, limit=max_speed)
+        results, start = [], 0
+        for k, window in enumerate(windows):
+            block = slice(start, start + len(window))
+            start += len(window)
+            reachable = np.flatnonzero(dist[k, block] <= speeds[k])
+            cells = [self.from_cell_number_to_coord(cell) for cell in window[reachable]]
+            # Convert the predecessors back to cell numbers of the whole grid.
+            previous = predecessor[k, block][reachable]
+            has_previous = previous >= 0
+            pred = dict(zip(window[reachable[has_previous]].tolist(),
+                            window[previous[has_previous] - block.start].tolist()))
+            results.append((cells, pred))
+        return results
+
+    def octile_distance(self, cell, other):
+        """
+        Cost of the shortest path between two cells on an empty grid.
+        As no move costs less, it is the heuristic of find_path.
+        """
+        dx = abs(cell % self.col - other % self.col)
+        dy = abs(cell // self.col - other // self.col)
+        return max(dx, dy) + (math.sqrt(2) - 1) * min(dx, dy)
+
+    def find_path(self, start, goal, box=None):
+        """
+        A* search of the shortest path from the start cell (i, j) to the goal.
+        Returns the list of cells to go through, goal included and start
+        excluded, or None if the goal cannot be reached. With a box
+        (left, bottom, right, top), the path stays inside it.
+        """
+        origin = self.from_coord_to_cell_number(*start)
+        dest = self.from_coord_to_cell_number(*goal)
+        if origin == dest:
+            return []
+        dist, predecessor = self._search(origin, dest, box=box)
+        if dest not in dist:
+            return None
+        return list(self.reconstruct_path(start[0], start[1],
+                                          goal[0], goal[1], predecessor))
 
     def reconstruct_path(self, i0, j0, i, j, predecessor):
         "Reconstruct the shortest path going from (i0, j0) to (i, j)."
@@ -569,3 +1730,667 @@ class DistanceMatrix(object):
 
         return reversed(path)
 
+
+
+class DistanceMatrix(GridGraph):
+    """
+    Distance matrix where we can add obstacles.
+    Can also be used to recontruct a shortest path, giving the predecessor matrix.
+
+    The sparse matrix always holds the 8 neighbour edges of every cell.
+    An edge that cannot be used has an infinite cost, so obstacles and
+    difficult terrains can be changed in place without touching the
+    structure of the matrix.
+    """
+    def __init__(self, row, col, obstacles=(), cf=1., diff_terrains=()):
+        """
+        Build the distance matrix of a row x col grid. The obstacles and the
+        difficult terrains (with cost factor cf) are applied in the same pass.
+        """
+        super(DistanceMatrix, self).__init__(row, col, obstacles, cf, diff_terrains)
+        self.dist_mat = self._build_matrix()
+
+    def _build_matrix(self):
+        """
+        Construct the sparse matrix from arrays of edges.
+        Cost to the distance matrix: Straight = 1; Diag = sqrt(2)
+        Each row holds the edges in the order of NEIGHBOURS, which is also the
+        order of the column indices. self.edges[cell, k] gives the position in
+        the matrix data of the edge going from cell to its kth neighbour
+        (-1 if it falls outside the grid).
+        """
+        size = self.row * self.col
+        cells = np.arange(size)
+        i, j = self.from_cell_number_to_coord(cells)
+        valid = np.zeros((size, len(NEIGHBOURS)), dtype=bool)
+        indices = np.zeros((size, len(NEIGHBOURS)), dtype=np.int32)
+        data = np.zeros((size, len(NEIGHBOURS)))
+        for k, (x_offset, y_offset) in enumerate(NEIGHBOURS):
+            valid[:, k] = self.valid_grid(i + x_offset, j + y_offset)
+            indices[:, k] = cells + self.from_coord_to_cell_number(x_offset, y_offset)
+            src = np.flatnonzero(valid[:, k])
+            data[src, k] = self._edge_weights(src, x_offset, y_offset)
+
+        self.edges = np.where(valid, np.cumsum(valid).reshape(valid.shape) - 1,
+                              -1).astype(np.int32)
+        indptr = np.concatenate(([0], np.cumsum(valid.sum(axis=1))))
+        return csr_matrix((data[valid], indices[valid], indptr), shape=(size, size))
+
+    def to_arrays(self):
+        "Returns a dict of the arrays from which from_arrays rebuilds the graph."
+        arrays = super(DistanceMatrix, self).to_arrays()
+        arrays.update(data=self.dist_mat.data, indices=self.dist_mat.indices,
+                      indptr=self.dist_mat.indptr, edges=self.edges)
+        return arrays
+
+    def _set_arrays(self, arrays):
+        "Set the state of the graph from the arrays given by to_arrays."
+        super(DistanceMatrix, self)._set_arrays(arrays)
+        size = self.row * self.col
+        self.dist_mat = csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(size, size))
+        self.edges = arrays['edges']
+
+    def _update_edges(self, i, j):
+        """
+        Recompute the edges affected by a change in cell (i, j). Those are the
+        edges leaving the cell and its neighbours: it covers the moves into
+        and out of the cell and the diagonals cutting its corner.
+        """
+        around = [(i + x, j + y) for x, y in NEIGHBOURS + [(0, 0)]
+                  if self.valid_grid(i + x, j + y)]
+        cells = self.from_coord_to_cell_number(*np.array(around).T)
+        for k, (x_offset, y_offset) in enumerate(NEIGHBOURS):
+            positions = self.edges[cells, k]
+            src = cells[positions >= 0]
+            self.dist_mat.data[positions[positions >= 0]] = \
+                self._edge_weights(src, x_offset, y_offset)
+
+    def _matrix(self):
+        "Returns the sparse matrix of the moves on the whole grid."
+        return self.dist_mat
+
+    def _neighbours(self, cell):
+        "Returns a list of (neighbour, cost) we can move to from the cell."
+        data = self.dist_mat.data
+        return [(cell + offset, data[position])
+                for offset, position in zip(self.offsets, self.edges[cell].tolist())
+                if position >= 0 and data[position] != np.inf]
+
+
+class CostRaster(GridGraph):
+    """
+    Matrix free pathfinding backend. The costs of the moves are computed
+    when needed from the obstacle and cost factor rasters, following the
+    same rules as the DistanceMatrix, so both give the same paths.
+    """
+    def _neighbours(self, cell):
+        "Returns a list of (neighbour, cost) we can move to from the cell."
+        obstacle, cost_factor = self.obstacle, self.cost_factor
+        i, j = self.from_cell_number_to_coord(cell)
+        neighbours = []
+        for x_offset, y_offset in NEIGHBOURS:
+            m, n = i + x_offset, j + y_offset
+            if not self.valid_grid(m, n):
+                continue
+            dest = self.from_coord_to_cell_number(m, n)
+            cost = math.sqrt(2) if x_offset and y_offset else 1.
+            # Same rules as _edge_weights
+            if obstacle[cell] or obstacle[dest]:
+                continue
+            if cost_factor[dest] == 1. and x_offset and y_offset and \
+                    obstacle[cell + x_offset] and obstacle[cell + y_offset * self.col]:
+                continue
+            neighbours.append((dest, cost * cost_factor[dest]))
+        return neighbours
+
+
+
+class DistanceField(object):
+    """
+    Cost to reach the closest of a set of target cells from every cell of
+    the grid, and the next cell to move to on the way (the flow).
+    """
+    def __init__(self, graph, dist, next_cell):
+        self.graph = graph
+        self.dist = dist
+        self.next_cell = next_cell
+
+    def cost(self, i, j):
+        "Cost to reach the closest target from (i, j), np.inf if unreachable"
+        return self.dist[self.graph.from_coord_to_cell_number(i, j)]
+
+    def next_step(self, i, j):
+        """
+        Returns the cell to move to from (i, j) towards the closest target,
+        or None if (i, j) is a target or cannot reach any.
+        """
+        cell = self.next_cell[self.graph.from_coord_to_cell_number(i, j)]
+        if cell < 0:
+            return None
+        return self.graph.from_cell_number_to_coord(cell)
+
+    def path(self, i, j):
+        "Returns the list of cells from (i, j) to the closest target, excluded (i, j)."
+        path = []
+        step = self.next_step(i, j)
+        while step is not None:
+            path.append(step)
+            step = self.next_step(*step)
+        return path
+
+
+class ClusterGraph(object):
+    """
+    Hierarchical pathfinding (HPA*) on top of a GridGraph, for very large maps.
+    The grid is split in square clusters. Where we can cross the border
+    between two clusters, the cells on both sides become the nodes of an
+    abstract graph. The nodes are linked by the cost of crossing the border
+    and by the cost of the shortest path between nodes of the same cluster.
+    A path is first searched in this small graph and then refined inside
+    each cluster it goes through.
+    """
+    # Entrances at least this long get a crossing at both ends, instead of
+    # a single one in their middle.
+    LONG_ENTRANCE = 6
+    # Number of clusters searched together in a single dijkstra call
+    CHUNK = 16
+
+    def __init__(self, graph, size=16):
+        self.graph = graph
+        self.size = size
+        self.cols = -(-graph.col // size)
+        self.rows = -(-graph.row // size)
+        # {(cluster, next cluster): [(node, next node), ...]} where we can cross
+        self.borders = {}
+        # {node: {node in the next cluster: cost}}
+        self.crossings = collections.defaultdict(dict)
+        # {cluster: {node: {node of the same cluster: cost}}}
+        self.paths = {}
+        clusters = [(x, y) for y in range(self.rows) for x in range(self.cols)]
+        for cluster in clusters:
+            for other in self._next_clusters(cluster):
+                self._build_border(cluster, other)
+        self._build_paths(clusters)
+        graph.observers.append(self)
+
+    def cluster(self, cell):
+        "Returns the cluster (x, y) of the cell number"
+        i, j = self.graph.from_cell_number_to_coord(cell)
+        return i // self.size, j // self.size
+
+    def box(self, cluster):
+        "Returns the cells of the cluster as a box (left, bottom, right, top)"
+        x, y = cluster
+        return (x * self.size, y * self.size,
+                min((x + 1) * self.size, self.graph.col),
+                min((y + 1) * self.size, self.graph.row))
+
+    def _next_clusters(self, cluster):
+        """
+        Returns the clusters on the right, top left, top and top right of the
+        cluster. So each pair of adjacent clusters is given once.
+        """
+        x, y = cluster
+        return [(m, n) for m, n in ((x + 1, y), (x - 1, y + 1), (x, y + 1), (x + 1, y + 1))
+                if 0 <= m < self.cols and n < self.rows]
+
+    def _nodes(self, cluster):
+        "Returns the sorted nodes of the cluster"
+        x, y = cluster
+        nodes = set()
+        for other in self._next_clusters(cluster):
+            nodes.update(node for node, _ in self.borders.get((cluster, other), []))
+        for other in ((x - 1, y), (x + 1, y - 1), (x, y - 1), (x - 1, y - 1)):
+            nodes.update(node for _, node in self.borders.get((other, cluster), []))
+        return sorted(nodes)
+
+    def _move_cost(self, cell, other):
+        "Cost of the move between two neighbour cells, np.inf if blocked"
+        return dict(self.graph._neighbours(cell)).get(other, np.inf)
+
+    def _build_border(self, cluster, other):
+        "Find where we can cross the border between cluster and the next one."
+        for node, next_node in self.borders.pop((cluster, other), []):
+            self.crossings[node].pop(next_node, None)
+            self.crossings[next_node].pop(node, None)
+        ctc = self.graph.from_coord_to_cell_number
+        left, bottom, right, top = self.box(cluster)
+        if other[0] != cluster[0] and other[1] != cluster[1]:
+            # Diagonal clusters only share the move across their corner.
+            if other[0] > cluster[0]:
+                crossings = [(ctc(right - 1, top - 1), ctc(right, top))]
+            else:
+                crossings = [(ctc(left, top - 1), ctc(left - 1, top))]
+        else:
+            crossings = self._find_crossings(cluster, other)
+
+        border = []
+        for node, next_node in crossings:
+            cost = self._move_cost(node, next_node)
+            back_cost = self._move_cost(next_node, node)
+            if cost == back_cost == np.inf:
+                continue
+            if cost != np.inf:
+                self.crossings[node][next_node] = cost
+            if back_cost != np.inf:
+                self.crossings[next_node][node] = back_cost
+            border.append((node, next_node))
+        self.borders[(cluster, other)] = border
+
+    def _find_crossings(self, cluster, other):
+        """
+        Returns the (node, next node) crossings of the border between the
+        cluster and the next one on its right or on its top.
+        """
+        ctc = self.graph.from_coord_to_cell_number
+        left, bottom, right, top = self.box(cluster)
+        if other[0] > cluster[0]:
+            pairs = [(ctc(right - 1, y), ctc(right, y)) for y in range(bottom, top)]
+        else:
+            pairs = [(ctc(x, top - 1), ctc(x, top)) for x in range(left, right)]
+        # Pairs of cells facing each other where we can cross both ways
+        open_pairs = [np.inf not in (self._move_cost(node, next_node),
+                                     self._move_cost(next_node, node))
+                      for node, next_node in pairs]
+        # Entrances are runs of such pairs. Along a run, the cells on each
+        # side are free so we can go from one crossing to another without
+        # leaving the cluster.
+        crossings, entrance = [], []
+        for pair, is_open in zip(pairs + [None], open_pairs + [False]):
+            if is_open:
+                entrance.append(pair)
+                continue
+            if len(entrance) >= self.LONG_ENTRANCE:
+                crossings.extend((entrance[0], entrance[-1]))
+            elif entrance:
+                crossings.append(entrance[len(entrance) // 2])
+            entrance = []
+        # A diagonal move across the border can be replaced by going through
+        # an entrance, unless both pairs it cuts across are closed.
+        for k in range(len(pairs) - 1):
+            if not open_pairs[k] and not open_pairs[k + 1]:
+                crossings.append((pairs[k][0], pairs[k + 1][1]))
+                crossings.append((pairs[k + 1][0], pairs[k][1]))
+        return crossings
+
+    def _build_paths(self, clusters):
+        "Compute the cost of the shortest paths between the nodes of each cluster."
+        for k in range(0, len(clusters), self.CHUNK):
+            chunk = clusters[k:k + self.CHUNK]
+            graph, windows = self.graph._window_graph([self.box(c) for c in chunk])
+            nodes = [self._nodes(cluster) for cluster in chunk]
+            # Index of the nodes in the matrix
+            local, start = [], 0
+            for window, cluster_nodes in zip(windows, nodes):
+                local.append(start + np.searchsorted(window, cluster_nodes))
+                start += len(window)
+            indices = np.concatenate(local).astype(int)
+            dist = dijkstra(graph, indices=indices) if len(indices) else None
+            row = 0
+            for cluster, cluster_nodes, cluster_local in zip(chunk, nodes, local):
+                paths = {}
+                for node in cluster_nodes:
+                    costs = dist[row, cluster_local].tolist()
+                    paths[node] = {other: cost for other, cost in zip(cluster_nodes, costs)
+                                   if other != node and cost != np.inf}
+                    row += 1
+                self.paths[cluster] = paths
+
+    def on_terrain_change(self, i, j):
+        """
+        Update the clusters around the edited cell (i, j). The moves which
+        changed all stay in the clusters of the cell and of its neighbours.
+        """
+        graph = self.graph
+        clusters = set(self.cluster(graph.from_coord_to_cell_number(i + x, j + y))
+                       for x, y in NEIGHBOURS + [(0, 0)] if graph.valid_grid(i + x, j + y))
+        for cluster in clusters:
+            for other in self._next_clusters(cluster):
+                if other in clusters:
+                    self._build_border(cluster, other)
+        self._build_paths(sorted(clusters))
+
+    def find_path(self, start, goal):
+        """
+        Near shortest path from the start cell (i, j) to the goal.
+        Returns the list of cells to go through, goal included and start
+        excluded, or None if the goal cannot be reached.
+        """
+        graph = self.graph
+        origin = graph.from_coord_to_cell_number(*start)
+        dest = graph.from_coord_to_cell_number(*goal)
+        if origin == dest:
+            return []
+        # The start and the goal are temporary nodes linked to the nodes of
+        # their clusters. A single dijkstra call gives the costs from the start
+        # and towards the goal.
+        START, GOAL = -1, -2
+        start_cluster, goal_cluster = self.cluster(origin), self.cluster(dest)
+        start_nodes, goal_nodes = self._nodes(start_cluster), self._nodes(goal_cluster)
+        matrix, (start_window, goal_window) = graph._window_graph(
+                            [self.box(start_cluster), self.box(goal_cluster)])
+        goal_local = len(start_window) + np.searchsorted(goal_window, goal_nodes + [dest])
+        indices = [np.searchsorted(start_window, origin)] + goal_local[:-1].tolist()
+        dist = dijkstra(matrix, indices=indices)
+        costs = dist[0, np.searchsorted(start_window, start_nodes + [dest])].tolist()
+        from_start = dict((node, cost) for node, cost in zip(start_nodes, costs)
+                          if cost != np.inf)
+        if start_cluster == goal_cluster and costs[-1] != np.inf:
+            from_start[GOAL] = costs[-1]
+        to_goal = dict((node, cost) for node, cost
+                       in zip(goal_nodes, dist[1:, goal_local[-1]].tolist())
+                       if cost != np.inf)
+
+        def neighbours(node):
+            if node == START:
+                return from_start.items()
+            result = list(self.crossings.get(node, {}).items())
+            result.extend(self.paths[self.cluster(node)].get(node, {}).items())
+            if node in to_goal:
+                result.append((GOAL, to_goal[node]))
+            return result
+
+        # A* in the abstract graph
+        cells = {START: origin, GOAL: dest}
+        dist, predecessor = {START: 0.}, {}
+        heap = [(0., 0., START)]
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == GOAL:
+                break
+            if cost > dist[node]:
+                continue
+            for neighbour, weight in neighbours(node):
+                new_cost = cost + weight
+                if new_cost < dist.get(neighbour, np.inf):
+                    dist[neighbour] = new_cost
+                    predecessor[neighbour] = node
+                    heapq.heappush(heap, (new_cost + graph.octile_distance(
+                        cells.get(neighbour, neighbour), dest), new_cost, neighbour))
+        if GOAL not in dist:
+            return None
+
+        nodes = [GOAL]
+        while nodes[-1] != START:
+            nodes.append(predecessor[nodes[-1]])
+        # Refine the abstract path: crossing a border is a single move, other
+        # parts are searched inside their cluster.
+        path, current = [], origin
+        for node in reversed(nodes[:-1]):
+            cell = cells.get(node, node)
+            cluster = self.cluster(current)
+            if self.cluster(cell) != cluster:
+                path.append(graph.from_cell_number_to_coord(cell))
+            else:
+                path.extend(graph.find_path(graph.from_cell_number_to_coord(current),
+                                            graph.from_cell_number_to_coord(cell),
+                                            box=self.box(cluster)))
+            current = cell
+        return path
+
+
+class LineOfSight(object):
+    """
+    Index of the cells hidden from each other by the obstacles of a
+    GridGraph: the line of library.get_line between them goes through an
+    obstacle (the end cells included).
+    For each origin cell, a window of the cells within radius tells which
+    ones are hidden. The window is computed the first time the origin is
+    used and dropped when an obstacle changes in range. The lines only
+    depend on the offset between their ends, so the cells of the lines
+    are computed once for all the offsets of the window.
+    Cells further than radius are checked along their line.
+    """
+    def __init__(self, graph, radius=LOS_RANGE, maxsize=LOS_CACHE_SIZE):
+        self.graph = graph
+        self.radius = radius
+        size, length = 2 * radius + 1, radius + 1
+        offset_x, offset_y = [a.ravel() for a in np.mgrid[-radius:radius + 1,
+                                                          -radius:radius + 1]]
+        x, y, starts = library.get_lines(0, 0, offset_x, offset_y)
+        # {(x offset, y offset): [offsets of the cells of the line]}
+        self.lines = {}
+        for k, (dx, dy) in enumerate(zip(offset_x.tolist(), offset_y.tolist())):
+            self.lines[(dx, dy)] = list(zip(x[starts[k]:starts[k + 1]].tolist(),
+                                            y[starts[k]:starts[k + 1]].tolist()))
+        # The x and y offsets of the cells of each line of the window, indexed
+        # by [dx + radius, dy + radius, k]. Short lines repeat their last cell.
+        cells = starts[:-1, np.newaxis] + np.minimum(
+                    np.arange(length), np.diff(starts)[:, np.newaxis] - 1)
+        self.line_x = x[cells].reshape(size, size, length)
+        self.line_y = y[cells].reshape(size, size, length)
+        # The same lines as indices of the cells in the window, indexed by
+        # the index of their last cell. line_inner tells the cells which are
+        # not the last one.
+        self.line_cells = ((self.line_x + radius) * size +
+                           self.line_y + radius).reshape(size * size, length)
+        self.line_inner = self.line_cells != np.arange(size * size)[:, np.newaxis]
+        # Hidden windows by origin cell (i, j)
+        self.windows = library.LRUCache(maxsize)
+        graph.observers.append(self)
+
+    def get_line(self, posA, posB):
+        "Returns the cells (i, j) of the line going from posA to posB."
+        i0, j0 = posA
+        i1, j1 = posB
+        line = self.lines.get((i1 - i0, j1 - j0))
+        if line is None:
+            return library.get_line(i0, j0, i1, j1)
+        return [(i0 + dx, j0 + dy) for dx, dy in line]
+
+    def is_hidden(self, posA, posB):
+        "Is there an obstacle on the line going from posA to posB?"
+        i0, j0 = posA
+        i1, j1 = posB
+        dx, dy = i1 - i0, j1 - j0
+        if max(abs(dx), abs(dy)) > self.radius:
+            graph = self.graph
+            return any(graph.obstacle[graph.from_coord_to_cell_number(i, j)]
+                       for i, j in library.iter_line(i0, j0, i1, j1))
+        return bool(self._window(i0, j0)[dx + self.radius, dy + self.radius])
+
+    def are_visible(self, posA, cells, blockers):
+        """
+        For each cell (i, j) of the cells array, returns 1 if it can be seen
+        from posA, 0 if it cannot and -1 if it is out of the index range.
+        A cell is seen if there is no obstacle on the line and no blocker,
+        like a ship, on the cells between both ends.
+        """
+        i0, j0 = posA
+        radius, size = self.radius, 2 * self.radius + 1
+        result = np.full(len(cells), -1)
+        # Index of the cells in the window
+        x, y = cells[:, 0] - (i0 - radius), cells[:, 1] - (j0 - radius)
+        indexed = np.flatnonzero((x >= 0) & (y >= 0) & (x < size) & (y < size))
+        if not len(indexed):
+            return result
+        offsets = x[indexed] * size + y[indexed]
+        # The blockers in the window, but the one on posA
+        occupied = np.zeros(size * size, dtype=bool)
+        x, y = blockers[:, 0] - (i0 - radius), blockers[:, 1] - (j0 - radius)
+        near = (x >= 0) & (y >= 0) & (x < size) & (y < size)
+        occupied[x[near] * size + y[near]] = True
+        occupied[radius * size + radius] = False
+        blocked = (occupied[self.line_cells[offsets]] & self.line_inner[offsets]).any(axis=1)
+        result[indexed] = ~self._window(i0, j0).ravel()[offsets] & ~blocked
+        return result
+
+    def _window(self, i, j):
+        "Returns the hidden window of the cell (i, j), building it if needed."
+        window = self.windows.get((i, j))
+        if window is None:
+            window = self._build_window(i, j)
+            self.windows.put((i, j), window)
+        return window
+
+    def _build_window(self, i, j):
+        """
+        Returns the boolean array telling, for each offset of the window,
+        if the line from (i, j) goes through an obstacle. The lines ending
+        outside the grid are clipped to it and must not be used.
+        """
+        graph = self.graph
+        x = np.clip(i + self.line_x, 0, graph.col - 1)
+        y = np.clip(j + self.line_y, 0, graph.row - 1)
+        return graph.obstacle[graph.from_coord_to_cell_number(x, y)].any(axis=2)
+
+    def on_terrain_change(self, i, j):
+        "Drop the windows of the cells in range of the changed cell (i, j)."
+        for x in range(i - self.radius, i + self.radius + 1):
+            for y in range(j - self.radius, j + self.radius + 1):
+                self.windows.pop((x, y))
+
+
+class FleetVisibility(object):
+    """
+    Fog of war: the cells the fleet of each player sees.
+    A ship sees the cells in its sensor range, or in its weapon range if
+    longer, which are not in the shadow of an obstacle of the graph. The
+    obstacles are seen but hide what is behind them. The cells are found
+    by recursive shadowcasting over the 8 octants around the ship.
+    The view of each ship is kept with the number of ships of each player
+    seeing each cell, so only the views of the ships which moved, changed
+    range, were removed or had an obstacle changed in range are computed
+    again.
+    """
+    # Transforms from the coords in the first octant to the 8 octants
+    OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+    def __init__(self, graph, sensor_range=SENSOR_RANGE):
+        self.graph = graph
+        self.sensor_range = sensor_range
+        # {ship: (cell (i, j), array of the cell numbers seen, range)}
+        self.views = {}
+        # {player: {cell number: number of ships of the player seeing it}}
+        self.seen = collections.defaultdict(collections.Counter)
+        graph.observers.append(self)
+
+    def get_range(self, ship):
+        """
+        Returns the distance up to which the ship sees. A jammed weapon
+        leaves the ship with its sensors only.
+        """
+        if ship.weapon is None:
+            return self.sensor_range
+        return max(self.sensor_range, ship.weapon.range)
+
+    def update(self, ship, i, j):
+        """
+        Compute the view of the ship in the cell (i, j), unless it did not
+        move nor change range.
+        """
+        radius = self.get_range(ship)
+        view = self.views.get(ship)
+        if view is not None and view[0] == (i, j) and view[2] == radius:
+            return
+        self.remove(ship)
+        cells = self.field_of_view(i, j, radius)
+        self.views[ship] = (i, j), cells, radius
+        self.seen[ship.player].update(cells.tolist())
+
+    def update_ranges(self):
+        "Compute again the views of the ships whose range changed."
+        for ship, (cell, _, radius) in list(self.views.items()):
+            if self.get_range(ship) != radius:
+                self.update(ship, *cell)
+
+    def remove(self, ship):
+        "Remove the view of the ship."
+        view = self.views.pop(ship, None)
+        if view is None:
+            return
+        seen = self.seen[ship.player]
+        for cell in view[1].tolist():
+            seen[cell] -= 1
+            if not seen[cell]:
+                del seen[cell]
+
+    def is_visible(self, player, i, j):
+        "Does the fleet of the player see the cell (i, j)?"
+        return self.graph.from_coord_to_cell_number(i, j) in self.seen.get(player, ())
+
+    def visible_cells(self, player):
+        "Returns the array of the numbers of the cells the player sees."
+        return np.fromiter(self.seen.get(player, ()), dtype=int)
+
+    def visible_mask(self, player):
+        "Returns a col x row boolean array set for the cells the player sees."
+        mask = np.zeros(self.graph.row * self.graph.col, dtype=bool)
+        mask[self.visible_cells(player)] = True
+        return mask.reshape(self.graph.row, self.graph.col).T
+
+    def field_of_view(self, i, j, radius):
+        """
+        Returns the array of the numbers of the cells seen from the cell
+        (i, j) up to radius.
+        """
+        graph, size = self.graph, 2 * radius + 1
+        # The obstacles around (i, j), the cells out of the grid are blocked
+        x, y = np.mgrid[i - radius:i + radius + 1, j - radius:j + radius + 1]
+        inside = graph.valid_grid(x, y)
+        blocked = np.ones((size, size), dtype=bool)
+        blocked[inside] = graph.obstacle[graph.from_coord_to_cell_number(x[inside], y[inside])]
+        blocked = blocked.tolist()
+        seen = np.zeros((size, size), dtype=bool)
+        seen[radius, radius] = True
+        for transform in self.OCTANTS:
+            self._cast_light(blocked, seen, radius, 1, 1., 0., transform)
+        seen &= inside
+        return graph.from_coord_to_cell_number(x[seen], y[seen])
+
+    def _cast_light(self, blocked, seen, radius, row, start, end, transform):
+        """
+        Mark as seen the cells of the octant in the light between the slopes
+        start and end, from the distance row. The octant is mapped onto the
+        window with the transform (xx, xy, yx, yy). Each obstacle met casts
+        a shadow: the light is split around it and the part before is cast
+        further recursively.
+        """
+        if start < end:
+            return
+        xx, xy, yx, yy = transform
+        radius_squared = radius * radius
+        new_start = start
+        for distance in range(row, radius + 1):
+            dy = -distance
+            in_shadow = False
+            for dx in range(-distance, 1):
+                # Slopes of the left and right edges of the cell
+                l_slope = (dx - 0.5) / (dy + 0.5)
+                r_slope = (dx + 0.5) / (dy - 0.5)
+                if start < r_slope:
+                    continue
+                if end > l_slope:
+                    break
+                x = radius + dx * xx + dy * xy
+                y = radius + dx * yx + dy * yy
+                if dx * dx + dy * dy <= radius_squared:
+                    seen[x, y] = True
+                if in_shadow:
+                    if blocked[x][y]:
+                        new_start = r_slope
+                    else:
+                        in_shadow = False
+                        start = new_start
+                elif blocked[x][y] and distance < radius:
+                    in_shadow = True
+                    self._cast_light(blocked, seen, radius, distance + 1,
+                                     start, l_slope, transform)
+                    new_start = r_slope
+            if in_shadow:
+                break
+
+    def on_terrain_change(self, i, j):
+        "Compute again the views of the ships in range of the changed cell (i, j)."
+        for ship, (cell, _, radius) in list(self.views.items()):
+            if max(abs(cell[0] - i), abs(cell[1] - j)) <= radius:
+                self.remove(ship)
+                self.update(ship, *cell)
+
+
+# Pathfinding backends which can be set with the 'pathfinding' battlemap key
+PATHFINDERS = {"distance matrix": DistanceMatrix,
+               "cost raster": CostRaster}
@@ -1,3 +1,7 @@
+import collections, os, json, hashlib, shutil, tempfile
+
+import numpy as np
+
 def get_line(x1, y1, x2, y2):
     points = []
     issteep = abs(y2-y1) > abs(x2-x1)
@@ -31,3 +35,222 @@ def get_line(x1, y1, x2, y2):
     if rev:
         points.reverse()
     return points
+
+def iter_line(x1, y1, x2, y2):
+    """
+    Generator of the cells of get_line, one at a time, so the caller can
+    stop at the first blocked cell.
+    The kth cell along the major axis is the one Bresenham's algorithm
+    reaches after k steps, so the line is the same in both directions of
+    the loop.
+    """
+    issteep = abs(y2-y1) > abs(x2-x1)
+    if issteep:
+        x1, y1 = y1, x1
+        x2, y2 = y2, x2
+    rev = False
+    if x1 > x2:
+        x1, x2 = x2, x1
+        y1, y2 = y2, y1
+        rev = True
+    deltax = x2 - x1
+    deltay = abs(y2-y1)
+    error = deltax // 2
+    if y1 < y2:
+        ystep = 1
+    else:
+        ystep = -1
+    # Reverse the line if the coordinates were reversed
+    steps = range(deltax, -1, -1) if rev else range(deltax + 1)
+    for t in steps:
+        # Number of times the error went below 0 in t steps
+        y = y1 + ystep * -((error - t * deltay) // max(deltax, 1))
+        if issteep:
+            yield (y, x1 + t)
+        else:
+            yield (x1 + t, y)
+
+def get_lines(x1, y1, x2, y2):
+    """
+    Same as get_line for arrays of end points, all the lines computed at
+    once. Returns the arrays (x, y, offsets), where the cells of the kth
+    line are x[offsets[k]:offsets[k+1]] and y[offsets[k]:offsets[k+1]].
+    """
+    x1, y1, x2, y2 = [a.ravel() for a in np.broadcast_arrays(
+                        *[np.asarray(a, dtype=int) for a in (x1, y1, x2, y2)])]
+    issteep = np.abs(y2 - y1) > np.abs(x2 - x1)
+    # Coords along the major axis u and the minor axis v
+    u1, v1 = np.where(issteep, y1, x1), np.where(issteep, x1, y1)
+    u2, v2 = np.where(issteep, y2, x2), np.where(issteep, x2, y2)
+    rev = u1 > u2
+    u1, u2, v1, v2 = (np.where(rev, u2, u1), np.where(rev, u1, u2),
+                      np.where(rev, v2, v1), np.where(rev, v1, v2))
+    deltau = u2 - u1
+    deltav = np.abs(v2 - v1)
+    error = deltau // 2
+    vstep = np.where(v1 < v2, 1, -1)
+
+    lengths = deltau + 1
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    # Line of each cell and its position k in the line
+    line = np.repeat(np.arange(len(lengths)), lengths)
+    k = np.arange(offsets[-1]) - offsets[line]
+    t = np.where(rev[line], deltau[line] - k, k)
+    v = v1[line] + vstep[line] * -((error[line] - t * deltav[line]) //
+                                   np.maximum(deltau[line], 1))
+    u = u1[line] + t
+    steep = issteep[line]
+    return np.where(steep, v, u), np.where(steep, u, v), offsets
+
+CacheInfo = collections.namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+class LRUCache(object):
+    """
+    Mapping with a maximum size. When it is full, storing a new key evicts
+    the entry which was not used for the longest time.
+    Hits and misses are counted so the cache can be profiled, see info.
+    If given, on_evict(key, value) is called for each evicted entry.
+    """
+    def __init__(self, maxsize=128, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        "Returns the value stored for key and marks it as recently used."
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        "Store the value for key, evicting the least recently used entries."
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            evicted = self._entries.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(*evicted)
+
+    def pop(self, key, default=None):
+        "Remove the entry of key and returns its value, or default."
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        "Remove all the entries. The hit and miss counts are kept."
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def info(self):
+        "Returns the hits, misses, maxsize and current size of the cache."
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+class DiskCache(object):
+    """
+    Directory of entries made of named numpy arrays. Each entry is a
+    subdirectory holding one .npy file per array, and the MANIFEST file
+    listing them: an entry missing any of them is a miss. The arrays are loaded
+    memory-mapped in copy-on-write mode: they can be changed in memory
+    without touching the files.
+    When the files take more than maxsize bytes, the entries which were not
+    used for the longest time are deleted.
+    """
+    # File of an entry listing the names of its arrays
+    MANIFEST = 'arrays.json'
+
+    def __init__(self, directory, maxsize=64 * 2**20):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def make_key(*data):
+        "Returns a key hashing the JSON serializable data."
+        text = json.dumps(data, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        """
+        Returns a dict {name: array} of the entry stored for key and marks it
+        as recently used.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, self.MANIFEST)) as manifest:
+                names = json.load(manifest)
+            arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                         mmap_mode='c'))
+                          for name in names)
+            os.utime(path, None)
+        except (OSError, IOError, ValueError):
+            # Missing, incomplete or unreadable entry. A broken one is
+            # deleted and stored again.
+            shutil.rmtree(path, ignore_errors=True)
+            self.misses += 1
+            return default
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Store the dict {name: array} for key, evicting the least recently
+        used entries. Returns False if the entry could not be written.
+        """
+        path = os.path.join(self.directory, key)
+        tmp = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # The files are written aside first, so an entry is never seen
+            # half written.
+            tmp = tempfile.mkdtemp(prefix='.', dir=self.directory)
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+            with open(os.path.join(tmp, self.MANIFEST), 'w') as manifest:
+                json.dump(sorted(arrays), manifest)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp, path)
+        except (OSError, IOError):
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        "Delete the least recently used entries until the cache fits in maxsize."
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name))
+                       for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def info(self):
+        "Returns the hits, misses, maxsize (in bytes) and number of entries."
+        try:
+            currsize = len([key for key in os.listdir(self.directory)
+                            if not key.startswith('.')])
+        except OSError:
+            currsize = 0
+        return CacheInfo(self.hits, self.misses, self.maxsize, currsize)
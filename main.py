@@ -11,13 +11,14 @@ from cocos.director import director
 
 import pyglet
 
-SCREEN_W, SCREEN_H = 1120, 630 #16/9 aspect ratio. Small enough for my laptop to work comfortably
-
+import resources
 
+SCREEN_W, SCREEN_H = 1120, 630 #16/9 aspect ratio. Small enough for my laptop to work comfortably
 
 def load_resource():
     pyglet.resource.path = ['res', 'res/images', 'res/fonts']
     pyglet.resource.reindex()
+    resources.load_atlas()
     pyglet.resource.add_font('Classic Robot.ttf')
     action_man = pyglet.font.load('Classic Robot')
     pyglet.resource.add_font('Classic Robot Bold.ttf')
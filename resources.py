@@ -0,0 +1,71 @@
+import numpy as np
+
+import pyglet
+
+# Images packed into the texture atlases, with the keywords of the ImageGrid
+# splitting them into frames, if any. The frames are packed one by one, so a
+# long strip like the explosion fits in an atlas.
+ATLAS_IMAGES = {
+    'ship.png': None,
+    'ship1.png': None,
+    'ship2.png': None,
+    'aster3.png': {'rows': 6, 'columns': 5},
+    'nebulaes.png': {'rows': 3, 'columns': 3, 'row_padding': 1, 'column_padding': 1},
+    'explosion.png': {'rows': 1, 'columns': 90},
+    }
+# Width and height of the texture atlases
+ATLAS_SIZE = 2048
+# Transparent pixels around every image of the atlases, so a zoomed or
+# filtered sprite does not show the edges of its neighbours.
+ATLAS_PADDING = 2
+
+# The regions of the atlases by image name, a list of frames for the grids.
+# It lives here rather than in main, which runs as __main__: "import main"
+# would give a second, empty copy of it.
+atlas_regions = {}
+
+def pad_image(image, padding):
+    "Returns a copy of the image with a transparent border of padding pixels."
+    width, height = image.width, image.height
+    data = image.get_image_data().get_data('RGBA', width * 4)
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)
+    pixels = np.pad(pixels, ((padding, padding), (padding, padding), (0, 0)),
+                    'constant')
+    return pyglet.image.ImageData(width + 2 * padding, height + 2 * padding,
+                                  'RGBA', pixels.tobytes())
+
+def load_atlas():
+    """
+    Pack the images of ATLAS_IMAGES into as few textures as possible, so the
+    sprites drawn together do not switch textures.
+    """
+    images = []
+    for name, grid in ATLAS_IMAGES.items():
+        with pyglet.resource.file(name) as f:
+            image = pyglet.image.load(name, file=f)
+        if grid is None:
+            images.append((name, None, image))
+        else:
+            frames = list(pyglet.image.ImageGrid(image, **grid))
+            atlas_regions[name] = [None] * len(frames)
+            images.extend((name, k, frame) for k, frame in enumerate(frames))
+    # The atlases are filled by rows, which waste less space by decreasing height
+    images.sort(key=lambda item: item[2].height, reverse=True)
+    texture_bin = pyglet.image.atlas.TextureBin(ATLAS_SIZE, ATLAS_SIZE)
+    for name, k, image in images:
+        padded = texture_bin.add(pad_image(image, ATLAS_PADDING))
+        region = padded.get_region(ATLAS_PADDING, ATLAS_PADDING,
+                                   image.width, image.height)
+        if k is None:
+            atlas_regions[name] = region
+        else:
+            atlas_regions[name][k] = region
+
+def get_image(name):
+    """
+    Returns the region of the atlases of the image name, or the list of the
+    regions of its frames. See ATLAS_IMAGES.
+    """
+    if not atlas_regions:
+        load_atlas()
+    return atlas_regions[name]
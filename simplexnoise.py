@@ -36,10 +36,16 @@ number  as the parameter for the noise, all objects will end up with the same
 noise value  at each frame. By adding a second parameter on the second
 dimension, you can ensure that each gets a unique noise value and they don't
 all look identical.
+
+The functions ending in _array take numpy arrays of coordinates (broadcast
+together) and evaluate the noise for all the points at once. They return the
+same values as their scalar counterparts.
 """
 
 import math
 
+import numpy as np
+
 def octave_noise_2d(octaves, persistence, scale, x, y):
     """2D Multi-Octave Simplex noise.
 
@@ -515,6 +521,287 @@ def dot4d(g, x, y, z, w):
     return g[0]*x + g[1]*y + g[2]*z + g[3]*w
 
 
+def _chunked(function, *coords):
+    """Apply function to the broadcast coordinates arrays, chunk by chunk.
+
+    The chunks are small enough for the temporary arrays to stay in cache.
+    """
+    coords = np.broadcast_arrays(*[np.asarray(c, dtype=float) for c in coords])
+    noise = np.empty(coords[0].shape)
+    flat_coords, flat_noise = [c.ravel() for c in coords], noise.reshape(-1)
+    for k in range(0, len(flat_noise), _CHUNK):
+        flat_noise[k:k+_CHUNK] = function(*[c[k:k+_CHUNK] for c in flat_coords])
+    return noise
+
+def _octave_chunked(raw_noise, octaves, persistence, scale, *coords):
+    """Multi-Octave version of the raw_noise chunk function.
+
+    See octave_noise_2d.
+    """
+    def octave_noise(*coords):
+        total = 0.0
+        frequency = scale
+        amplitude = 1.0
+        maxAmplitude = 0.0
+
+        for i in range(octaves):
+            total = total + raw_noise(*[c * frequency for c in coords]) * amplitude
+            frequency *= 2.0
+            maxAmplitude += amplitude
+            amplitude *= persistence
+
+        return total / maxAmplitude
+
+    return _chunked(octave_noise, *coords)
+
+def octave_noise_2d_array(octaves, persistence, scale, x, y):
+    """2D Multi-Octave Simplex noise on arrays of coordinates.
+
+    See octave_noise_2d.
+    """
+    return _octave_chunked(_raw_noise_2d_chunk, octaves, persistence, scale,
+                           x, y)
+
+def octave_noise_3d_array(octaves, persistence, scale, x, y, z):
+    """3D Multi-Octave Simplex noise on arrays of coordinates.
+
+    See octave_noise_3d.
+    """
+    return _octave_chunked(_raw_noise_3d_chunk, octaves, persistence, scale,
+                           x, y, z)
+
+def octave_noise_4d_array(octaves, persistence, scale, x, y, z, w):
+    """4D Multi-Octave Simplex noise on arrays of coordinates.
+
+    See octave_noise_4d.
+    """
+    return _octave_chunked(_raw_noise_4d_chunk, octaves, persistence, scale,
+                           x, y, z, w)
+
+def scaled_octave_noise_2d_array(octaves, persistence, scale, loBound, hiBound, x, y):
+    """2D Scaled Multi-Octave Simplex noise on arrays of coordinates.
+
+    Returned values will be between loBound and hiBound.
+    """
+    return  (octave_noise_2d_array(octaves, persistence, scale, x, y) *
+            (hiBound - loBound) / 2 +
+            (hiBound + loBound) / 2)
+
+def scaled_octave_noise_3d_array(octaves, persistence, scale, loBound, hiBound, x, y, z):
+    """3D Scaled Multi-Octave Simplex noise on arrays of coordinates.
+
+    Returned values will be between loBound and hiBound.
+    """
+    return  (octave_noise_3d_array(octaves, persistence, scale, x, y, z) *
+            (hiBound - loBound) / 2 +
+            (hiBound + loBound) / 2)
+
+def scaled_octave_noise_4d_array(octaves, persistence, scale, loBound, hiBound, x, y, z, w):
+    """4D Scaled Multi-Octave Simplex noise on arrays of coordinates.
+
+    Returned values will be between loBound and hiBound.
+    """
+    return  (octave_noise_4d_array(octaves, persistence, scale, x, y, z, w) *
+            (hiBound - loBound) / 2 +
+            (hiBound + loBound) / 2)
+
+def raw_noise_2d_array(x, y):
+    """2D Raw Simplex noise on arrays of coordinates.
+
+    Same algorithm as raw_noise_2d, where the branches are replaced by masks
+    and the gradients are looked up for all the points at once.
+    """
+    return _chunked(_raw_noise_2d_chunk, x, y)
+
+def raw_noise_3d_array(x, y, z):
+    """3D Raw Simplex noise on arrays of coordinates.
+
+    See raw_noise_2d_array.
+    """
+    return _chunked(_raw_noise_3d_chunk, x, y, z)
+
+def raw_noise_4d_array(x, y, z, w):
+    """4D Raw Simplex noise on arrays of coordinates.
+
+    See raw_noise_2d_array.
+    """
+    return _chunked(_raw_noise_4d_chunk, x, y, z, w)
+
+def _add_contribution(n, t, offsets, gradients):
+    """Add the contribution of one simplex corner to the noise n.
+
+    t is the radius of the corner (0.6 in 3D), offsets the distances to the
+    corner and gradients the columns of the gradient of the corner.
+    """
+    t = t - offsets[0] * offsets[0]
+    for d in offsets[1:]:
+        t -= d * d
+    np.maximum(t, 0.0, out=t)
+    t *= t
+    t *= t
+    dot = gradients[0] * offsets[0]
+    for g, d in zip(gradients[1:], offsets[1:]):
+        dot += g * d
+    t *= dot
+    n += t
+
+def _raw_noise_2d_chunk(x, y):
+    """raw_noise_2d_array on 1D arrays.
+
+    The arrays are updated in place where possible, keeping the order of
+    the operations of raw_noise_2d so the results are the same.
+    """
+    # Skew the input space to determine which simplex cell we're in
+    F2 = 0.5 * (math.sqrt(3.0) - 1.0)
+    s = (x + y) * F2
+    # Like int(), astype truncates towards zero
+    i = (x + s).astype(np.int32)
+    j = (y + s).astype(np.int32)
+
+    G2 = (3.0 - math.sqrt(3.0)) / 6.0
+    t = (i + j) * G2
+    # The x,y distances from the cell origin
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+
+    # Offsets for second (middle) corner of simplex in (i,j) coords are
+    # (1,0) in the lower triangle and (0,1) in the upper triangle.
+    i1 = x0 > y0
+    x1 = x0 - i1
+    x1 += G2
+    y1 = y0 - ~i1
+    y1 += G2
+    x2 = x0 - 1.0
+    x2 += 2.0 * G2
+    y2 = y0 - 1.0
+    y2 += 2.0 * G2
+
+    # Index of the three simplex corners in the gradient tables, which hold
+    # _grad3[_perm[ii+_perm[jj]] % 12] at index ii*257 + jj
+    h0 = (i & 255) * 257
+    h0 += j & 255
+    h1 = i1 * 256
+    h1 += h0 + 1
+    h2 = h0 + 258
+
+    # Add the contributions from the three corners
+    n = np.zeros(x.shape)
+    for h, xc, yc in ((h0, x0, y0), (h1, x1, y1), (h2, x2, y2)):
+        _add_contribution(n, 0.5, (xc, yc), (_grad2_x.take(h), _grad2_y.take(h)))
+
+    # The result is scaled to return values in the interval [-1,1].
+    n *= 70.0
+    return n
+
+def _raw_noise_3d_chunk(x, y, z):
+    """raw_noise_3d_array on 1D arrays.
+
+    See _raw_noise_2d_chunk.
+    """
+    # Skew the input space to determine which simplex cell we're in
+    F3 = 1.0/3.0
+    s = (x + y + z) * F3
+    i = (x + s).astype(np.int32)
+    j = (y + s).astype(np.int32)
+    k = (z + s).astype(np.int32)
+
+    G3 = 1.0 / 6.0
+    t = (i + j + k) * G3
+    # The x,y,z distances from the cell origin
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+
+    # The comparisons of the branches of raw_noise_3d give the index of the
+    # simplex we are in, which holds the offsets of its second and third
+    # corners.
+    c = (x0 >= y0) * 4
+    c += (y0 >= z0) * 2
+    c += x0 >= z0
+    corners = [(0, x0, y0, z0)]
+    for m, offsets in enumerate(_simplex3[:, :, c]):
+        corners.append((offsets,
+                        x0 - offsets[0] + (m + 1) * G3,
+                        y0 - offsets[1] + (m + 1) * G3,
+                        z0 - offsets[2] + (m + 1) * G3))
+    corners.append((1, x0 - 1.0 + 3.0 * G3, y0 - 1.0 + 3.0 * G3,
+                    z0 - 1.0 + 3.0 * G3))
+
+    # Add the contributions from the four corners
+    ii = i & 255
+    jj = j & 255
+    kk = k & 255
+    n = np.zeros(x.shape)
+    for offsets, xc, yc, zc in corners:
+        offsets = np.broadcast_to(offsets, (3,) + x.shape)
+        gi = _perm_array[ii + offsets[0] +
+             _perm_array[jj + offsets[1] +
+             _perm_array[kk + offsets[2]]]] % 12
+        _add_contribution(n, 0.6, (xc, yc, zc), _grad3_array[:, gi])
+
+    # The result is scaled to stay just inside [-1,1]
+    n *= 32.0
+    return n
+
+def _raw_noise_4d_chunk(x, y, z, w):
+    """raw_noise_4d_array on 1D arrays.
+
+    See _raw_noise_2d_chunk.
+    """
+    # Skew the (x,y,z,w) space to determine which cell of 24 simplices we're in
+    F4 = (math.sqrt(5.0)-1.0) / 4.0
+    s = (x + y + z + w) * F4
+    i = (x + s).astype(np.int32)
+    j = (y + s).astype(np.int32)
+    k = (z + s).astype(np.int32)
+    l = (w + s).astype(np.int32)
+
+    G4 = (5.0-math.sqrt(5.0)) / 20.0
+    t = (i + j + k + l) * G4
+    # The x,y,z,w distances from the cell origin
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    w0 = w - (l - t)
+
+    # Index of the simplex we are in, see raw_noise_4d.
+    c = (x0 > y0) * 32
+    c += (x0 > z0) * 16
+    c += (y0 > z0) * 8
+    c += (x0 > w0) * 4
+    c += (y0 > w0) * 2
+    c += z0 > w0
+    simplex = _simplex_array[:, c]
+    corners = [(0, x0, y0, z0, w0)]
+    for m in (1, 2, 3):
+        # The corners are set in turn from the largest coordinate
+        offsets = simplex >= 4 - m
+        corners.append((offsets,
+                        x0 - offsets[0] + m * G4,
+                        y0 - offsets[1] + m * G4,
+                        z0 - offsets[2] + m * G4,
+                        w0 - offsets[3] + m * G4))
+    corners.append((1, x0 - 1.0 + 4.0 * G4, y0 - 1.0 + 4.0 * G4,
+                    z0 - 1.0 + 4.0 * G4, w0 - 1.0 + 4.0 * G4))
+
+    # Add the contributions from the five corners
+    ii = i & 255
+    jj = j & 255
+    kk = k & 255
+    ll = l & 255
+    n = np.zeros(x.shape)
+    for offsets, xc, yc, zc, wc in corners:
+        offsets = np.broadcast_to(offsets, (4,) + x.shape)
+        gi = _perm_array[ii + offsets[0] +
+             _perm_array[jj + offsets[1] +
+             _perm_array[kk + offsets[2] +
+             _perm_array[ll + offsets[3]]]]] % 32
+        _add_contribution(n, 0.6, (xc, yc, zc, wc), _grad4_array[:, gi])
+
+    # Sum up and scale the result to cover the range [-1,1]
+    n *= 27.0
+    return n
+
 """The gradients are the midpoints of the vertices of a cube."""
 _grad3 = [
     [1,1,0], [-1,1,0], [1,-1,0], [-1,-1,0],
@@ -574,3 +861,56 @@ _simplex = [
     [2,0,1,3],[0,0,0,0],[0,0,0,0],[0,0,0,0],[3,0,1,2],[3,0,2,1],[0,0,0,0],[3,1,2,0],
     [2,1,0,3],[0,0,0,0],[0,0,0,0],[0,0,0,0],[3,1,0,2],[0,0,0,0],[3,2,0,1],[3,2,1,0]
 ]
+
+# Number of points evaluated together by the _array functions
+_CHUNK = 8192
+
+# Tables for raw_noise_2d_array: the x and y of the gradient of the corner
+# (ii, jj), with ii and jj up to 256, at index ii*257 + jj.
+_grad2_index = np.array(_perm)[np.arange(257)[:, np.newaxis] +
+                               np.array(_perm)[np.arange(257)]] % 12
+_grad2_x = np.array(_grad3, dtype=float)[_grad2_index.ravel(), 0]
+_grad2_y = np.array(_grad3, dtype=float)[_grad2_index.ravel(), 1]
+
+# Tables for raw_noise_3d_array and raw_noise_4d_array
+_perm_array = np.array(_perm)
+_grad3_array = np.array(_grad3, dtype=float).T
+_grad4_array = np.array(_grad4, dtype=float).T
+_simplex_array = np.array(_simplex).T
+
+"""The offsets of the second and third corners of the 3D simplex for each
+index (x0 >= y0)*4 + (y0 >= z0)*2 + (x0 >= z0) of raw_noise_3d_array."""
+_simplex3 = np.array([
+    [[0,0,1], [0,0,1], [0,1,0], [0,1,0], [0,0,1], [1,0,0], [1,0,0], [1,0,0]],
+    [[0,1,1], [0,1,1], [0,1,1], [1,1,0], [1,0,1], [1,0,1], [1,1,0], [1,1,0]]
+]).transpose(0, 2, 1)
+
+if __name__ == '__main__':
+    # Micro-benchmark of the _array functions against the scalar ones
+    import timeit
+
+    size = 100
+    x, y = np.indices((size, size), dtype=float)
+    z = np.full_like(x, 0.5)
+    w = np.full_like(x, 1.5)
+    points = list(zip(x.ravel(), y.ravel()))
+    benchmarks = [
+        ("raw 2D", lambda: [raw_noise_2d(*p) for p in points],
+                   lambda: raw_noise_2d_array(x, y)),
+        ("raw 3D", lambda: [raw_noise_3d(*p + (0.5,)) for p in points],
+                   lambda: raw_noise_3d_array(x, y, z)),
+        ("raw 4D", lambda: [raw_noise_4d(*p + (0.5, 1.5)) for p in points],
+                   lambda: raw_noise_4d_array(x, y, z, w)),
+        ("octave 3D", lambda: [scaled_octave_noise_3d(4, 0.5, 0.1, 0, 255, *p + (0.5,))
+                               for p in points],
+                      lambda: scaled_octave_noise_3d_array(4, 0.5, 0.1, 0, 255, x, y, z)),
+        ("octave 4D", lambda: [scaled_octave_noise_4d(4, 0.5, 0.1, 0, 255, *p + (0.5, 1.5))
+                               for p in points],
+                      lambda: scaled_octave_noise_4d_array(4, 0.5, 0.1, 0, 255, x, y, z, w)),
+    ]
+    print("%d points per call, best of 3" % (size * size))
+    for name, scalar, array in benchmarks:
+        scalar_time = min(timeit.repeat(scalar, number=1, repeat=3))
+        array_time = min(timeit.repeat(array, number=1, repeat=3))
+        print("%-10s scalar %8.2f ms  array %6.2f ms  x%.0f" % (name,
+              scalar_time * 1000, array_time * 1000, scalar_time / array_time))
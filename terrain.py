@@ -0,0 +1,69 @@
+"""
+Noise terrain builder. Gives the cells of a battlemap where a simplex noise
+is above a threshold, as boolean masks.
+Big maps are split into tiles computed by a pool of processes. This module
+only depends on numpy and simplexnoise, so the processes of the pool do not
+load the graphics.
+"""
+import multiprocessing
+
+import numpy as np
+
+import simplexnoise
+
+# Size of the square tiles computed by each task of the pool
+TILE_SIZE = 256
+
+def noise_mask(params, x, y):
+    """
+    Given the params to generate a simplex noise, returns a boolean array
+    set where the noise of the cells (x, y) is above the defined threshold.
+    """
+    v = simplexnoise.scaled_octave_noise_2d_array(
+            params['octave'],
+            params['persistance'],
+            params['freq'],
+            0, 255,
+            x + params['x_off'],
+            y + params['y_off'])
+    c = np.maximum(v - params['sparsity'], 0)
+    noise = 255 - (np.power(params['density'], c) * 255)
+    return noise > 0.
+
+def _tile_mask(task):
+    "Returns the noise mask of one tile. Runs in the processes of the pool."
+    params, left, bottom, right, top = task
+    x, y = np.mgrid[left:right, bottom:top]
+    return noise_mask(params, x, y)
+
+def generate_masks(col, row, layers, processes=None, tile_size=TILE_SIZE):
+    """
+    Returns the col x row noise masks of each params of the list layers.
+    The tiles of all the layers are computed concurrently by a pool of
+    processes (as many as CPUs by default). A map which fits in one tile is
+    computed in this process, as starting the pool would cost more.
+    The noise of a cell does not depend on its tile, so the tiles are
+    assembled without seams.
+    """
+    tiles = [(left, bottom, min(left + tile_size, col), min(bottom + tile_size, row))
+             for left in range(0, col, tile_size)
+             for bottom in range(0, row, tile_size)]
+    tasks = [(params,) + tile for params in layers for tile in tiles]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+
+    if processes > 1 and len(tiles) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_tile_mask, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_tile_mask(task) for task in tasks]
+
+    masks = [np.zeros((col, row), dtype=bool) for _ in layers]
+    for k, (_, left, bottom, right, top) in enumerate(tasks):
+        masks[k // len(tiles)][left:right, bottom:top] = results[k]
+    return masks
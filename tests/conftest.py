@@ -0,0 +1,15 @@
+import json
+import os, sys
+
+import pytest
+
+# The modules of the game are at the root of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def battlemap():
+    "The keywords of the battlemap of battlemap.json."
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'battlemap.json')
+    with open(path) as f:
+        return json.load(f)['battlemap']
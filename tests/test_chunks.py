@@ -0,0 +1,92 @@
+"""
+A terrain streamed by chunks is the same as the terrain generated at once,
+and so are the paths searched on it.
+"""
+import random
+
+import numpy as np
+import pytest
+
+import terrain
+
+grid = pytest.importorskip('grid')
+
+COL, ROW = 97, 83
+
+def full_graph(params):
+    "The CostRaster of the whole terrain, generated at once."
+    diff_terrain, obstacle = terrain.generate_masks(
+            COL, ROW, [params['difficult terrain'], params['obstacle']], 1)
+    cost_factor = np.where(diff_terrain, params['difficult terrain']['cost factor'], 1.)
+    return grid.CostRaster.from_arrays(ROW, COL, {
+            'obstacle': (obstacle & ~diff_terrain).T.ravel(),
+            'cost_factor': cost_factor.T.ravel()})
+
+def chunked_graph(params, max_chunks=5):
+    chunks = grid.TerrainChunks(ROW, COL, params, 16, max_chunks)
+    return grid.CostRaster.from_arrays(ROW, COL, {
+            'obstacle': chunks.obstacle, 'cost_factor': chunks.cost_factor}), chunks
+
+def test_chunked_terrain_matches_full_terrain(battlemap):
+    full = full_graph(battlemap)
+    chunked, chunks = chunked_graph(battlemap)
+    cells = np.arange(ROW * COL)
+    assert np.array_equal(chunked.obstacle[cells], full.obstacle)
+    assert np.array_equal(chunked.cost_factor[cells], full.cost_factor)
+    # Only max_chunks chunks are kept in memory
+    assert len(chunks.chunks) == 5
+    for x_offset, y_offset in grid.NEIGHBOURS:
+        src = cells[full.valid_grid(cells % COL + x_offset, cells // COL + y_offset)]
+        assert np.array_equal(chunked._edge_weights(src, x_offset, y_offset),
+                              full._edge_weights(src, x_offset, y_offset))
+
+def test_chunked_pathfinding_matches_full_terrain(battlemap):
+    full = full_graph(battlemap)
+    chunked, _ = chunked_graph(battlemap, max_chunks=12)
+    rng = random.Random(3)
+    for _ in range(10):
+        i, j = rng.randrange(COL), rng.randrange(ROW)
+        assert chunked.get_reachable_cells(i, j, 7)[0] == full.get_reachable_cells(i, j, 7)[0]
+        start = rng.randrange(COL), rng.randrange(ROW)
+        goal = rng.randrange(COL), rng.randrange(ROW)
+        path, expected = chunked.find_path(start, goal), full.find_path(start, goal)
+        assert (path is None) == (expected is None)
+        if path:
+            assert len(path) == len(expected)
+    assert np.array_equal(chunked.get_distance_field([(3, 3)]).dist,
+                          full.get_distance_field([(3, 3)]).dist)
+
+def test_chunk_edits_survive_eviction(battlemap):
+    chunked, chunks = chunked_graph(battlemap, max_chunks=2)
+    free = [cell for cell in range(ROW * COL) if not chunked.obstacle[cell]]
+    edited = free[0]
+    i, j = chunked.from_cell_number_to_coord(edited)
+    chunked.add_obstacle(i, j)
+    # Load every chunk, so the edited one is evicted and generated again
+    chunked.obstacle[np.arange(ROW * COL)]
+    assert chunks.chunk_of(i, j) not in chunks.chunks
+    assert chunked.obstacle[edited]
+    chunked.remove_obstacle(i, j)
+    chunked.obstacle[np.arange(ROW * COL)]
+    assert not chunked.obstacle[edited]
+
+def test_cells_set_back_are_dropped_from_the_edits(battlemap):
+    chunked, chunks = chunked_graph(battlemap, max_chunks=2)
+    rng = random.Random(4)
+    cells = rng.sample(range(ROW * COL), 50)
+    generated = chunks.occupancy[np.array(cells)]
+    # Ships moving through the cells, as GridLayer sets their flags
+    for cell in cells:
+        flags = chunks.occupancy[cell]
+        chunks.occupancy[cell] = flags & (grid.ASTEROID | grid.NEBULA) | grid.SHIP
+        assert chunks.edits
+        chunks.occupancy[cell] = chunks.occupancy[cell] & (grid.ASTEROID | grid.NEBULA)
+    assert chunks.edits == {}
+    assert np.array_equal(chunks.occupancy[np.array(cells)], generated)
+    # An obstacle added and removed again
+    free = [cell for cell in cells if not chunked.obstacle[cell]]
+    i, j = chunked.from_cell_number_to_coord(free[0])
+    chunked.add_obstacle(i, j)
+    assert chunks.edits == {chunks.chunk_of(i, j): {('obstacle', i % 16, j % 16): True}}
+    chunked.remove_obstacle(i, j)
+    assert chunks.edits == {}
@@ -0,0 +1,174 @@
+"""
+The queries and highlights of the GridLayer. The layers are made without
+their sprites and vertex lists, which need a window: only the state the
+tested methods use is set.
+"""
+import random
+
+import numpy as np
+import pytest
+
+import library
+
+grid = pytest.importorskip('grid')
+
+def bare_layer(col, row):
+    "Returns a GridLayer of col x row cells without sprites nor graphics."
+    layer = grid.GridLayer.__new__(grid.GridLayer)
+    layer.col, layer.row = col, row
+    layer.overlays = dict((name, set()) for name, _ in grid.OVERLAYS)
+    layer.painted = {}
+    layer.dirty_cells = set()
+    return layer
+
+class Weapon(object):
+    def __init__(self, range):
+        self.range = range
+
+class Ship(object):
+    def __init__(self, player, position, weapon_range):
+        self.player = player
+        self.position = position
+        self.weapon = Weapon(weapon_range)
+
+def battle_layer(rng, col, row, los_range):
+    """
+    Returns a layer with random asteroids and ships, and the set of the
+    cells of the asteroids.
+    """
+    layer = bare_layer(col, row)
+    cells = [(i, j) for i in range(col) for j in range(row)]
+    asteroids = set(rng.sample(cells, len(cells) // 8))
+    layer.pathfinder = grid.DistanceMatrix(row, col, obstacles=asteroids)
+    layer.line_of_sight = grid.LineOfSight(layer.pathfinder, los_range)
+    layer.occupancy = np.zeros(col * row, dtype=np.uint8)
+    for i, j in asteroids:
+        layer.occupancy[i + j * col] |= grid.ASTEROID
+    layer.ship_table = grid.ShipTable()
+    layer.entities = {'ships': {}}
+    free = [cell for cell in cells if cell not in asteroids]
+    for i, j in rng.sample(free, 60):
+        ship = Ship(rng.choice('abc'), layer.from_grid_to_pixel(i, j),
+                    rng.choice([1, 3, 6, 12, 30]))
+        layer.entities['ships'][(i, j)] = ship
+        layer.ship_table.add(ship, i, j)
+        layer._set_ship_flags(ship, i, j)
+    return layer, asteroids
+
+def old_get_targets(layer, asteroids, ship, position):
+    "The targets of the ship, one ship and one line of sight at a time."
+    targets = []
+    for target in layer.entities['ships'].values():
+        target_pos = layer.from_pixel_to_grid(target.position)
+        if target.player == ship.player or \
+                layer.distance(position, target_pos) > ship.weapon.range:
+            continue
+        line = library.get_line(position[0], position[1], target_pos[0], target_pos[1])
+        if not any(cell in asteroids or cell in layer.entities['ships'] and
+                   cell != position and cell != target_pos for cell in line):
+            targets.append(target)
+    return targets
+
+@pytest.mark.parametrize('los_range', [1, 5, 15])
+def test_targets_match_the_loop_over_the_ships(los_range):
+    rng = random.Random(los_range)
+    layer, asteroids = battle_layer(rng, 40, 30, los_range)
+    for position, ship in layer.entities['ships'].items():
+        expected = old_get_targets(layer, asteroids, ship, position)
+        targets = layer.get_targets(ship)
+        assert len(targets) == len(set(targets))
+        assert set(targets) == set(expected), position
+    # From another position than the ship's
+    ship = rng.choice(list(layer.entities['ships'].values()))
+    for _ in range(50):
+        position = rng.randrange(40), rng.randrange(30)
+        assert set(layer.get_targets(ship, position)) == \
+            set(old_get_targets(layer, asteroids, ship, position))
+
+def record_highlights(layer):
+    "Returns the list of the (sorted cells, color) the layer will highlight."
+    writes = []
+    layer.highlight_cells = lambda cells, color: writes.append((sorted(cells), color))
+    return writes
+
+def test_overlays_paint_the_highest_priority():
+    layer = bare_layer(10, 10)
+    writes = record_highlights(layer)
+    layer.set_overlay('reachable', [(1, 1), (2, 2), (3, 3)])
+    layer.set_overlay('target', [(2, 2)])
+    layer.set_overlay('player turn', [(3, 3), (4, 4)])
+    layer.paint_overlays()
+    assert sorted(writes) == sorted([
+            ([(1, 1), (3, 3)], grid.REACHABLE_CELLS),
+            ([(2, 2)], grid.TARGET),
+            ([(4, 4)], grid.PLAYER_TURN)])
+    assert layer.painted == {(1, 1): 'reachable', (2, 2): 'target',
+                             (3, 3): 'reachable', (4, 4): 'player turn'}
+    # Nothing changed, nothing painted
+    del writes[:]
+    layer.paint_overlays()
+    assert writes == []
+
+def test_removing_the_top_overlay_reveals_the_one_below():
+    layer = bare_layer(10, 10)
+    writes = record_highlights(layer)
+    layer.set_overlay('selected', [(1, 1), (2, 2)])
+    layer.set_overlay('target', [(1, 1)])
+    layer.paint_overlays()
+    del writes[:]
+    layer.set_overlay('target', [])
+    layer.paint_overlays()
+    assert writes == [([(1, 1)], grid.SHIP_SELECTED)]
+    # The last overlay of a cell removed, it is cleared
+    del writes[:]
+    layer.remove_overlay('selected', [(1, 1)])
+    layer.paint_overlays()
+    assert writes == [([(1, 1)], grid.CLEAR_CELL)]
+    assert layer.painted == {(2, 2): 'selected'}
+
+def test_overlays_changed_back_between_paints_write_no_cell():
+    layer = bare_layer(10, 10)
+    writes = record_highlights(layer)
+    layer.set_overlay('reachable', [(1, 1)])
+    layer.paint_overlays()
+    del writes[:]
+    # Set then cleared
+    layer.set_overlay('selected', [(5, 5)])
+    layer.set_overlay('selected', [])
+    # Covered then uncovered
+    layer.add_overlay('target', [(1, 1)])
+    layer.remove_overlay('target', [(1, 1)])
+    # Cleared then set again
+    layer.clear_overlays([(1, 1)])
+    layer.add_overlay('reachable', [(1, 1)])
+    layer.paint_overlays()
+    assert writes == []
+    assert layer.painted == {(1, 1): 'reachable'}
+    assert not layer.dirty_cells
+
+def test_chunk_quads_keep_their_colors_when_chunks_are_shown(battlemap):
+    pyglet = pytest.importorskip('pyglet')
+    layer = bare_layer(50, 40)
+    layer.terrain = grid.TerrainChunks(40, 50, battlemap, 8)
+    layer.grid_batch = pyglet.graphics.Batch()
+    layer.quads_group = pyglet.graphics.OrderedGroup(1)
+    layer.cell_quads, layer.cell_colors, layer.colors_changed = {}, {}, set()
+    rng = random.Random(0)
+    chunks = [(ci, cj) for ci in range(7) for cj in range(5)]
+    rng.shuffle(chunks)
+    colors = {}
+    for chunk in chunks:
+        # The buffers of the chunks already shown are not moved
+        layer._add_cell_quads(chunk, layer.terrain.box(chunk))
+        cells = [(rng.randrange(50), rng.randrange(40)) for _ in range(30)]
+        color = [rng.randrange(256) for _ in range(4)]
+        layer.highlight_cells(cells, color)
+        for cell in cells:
+            if layer.terrain.chunk_of(*cell) in layer.cell_quads:
+                colors[cell] = color
+    for chunk, quads in layer.cell_quads.items():
+        left, bottom, right, top = layer.terrain.box(chunk)
+        written = np.array(quads.colors[:]).reshape(-1, 4, 4)
+        for k, vertices in enumerate(written.tolist()):
+            j, i = divmod(k, right - left)
+            assert vertices == [colors.get((left + i, bottom + j), [128, 128, 128, 0])] * 4
@@ -0,0 +1,123 @@
+import random
+
+import numpy as np
+
+import library
+
+def random_ends(count=5000, seed=0):
+    "Random end points, plus all the short lines around the origin."
+    rng = random.Random(seed)
+    ends = [tuple(rng.randint(-30, 30) for _ in range(4)) for _ in range(count)]
+    ends += [(x1, y1, x2, y2) for x1 in range(-3, 4) for y1 in range(-3, 4)
+             for x2 in range(-3, 4) for y2 in range(-3, 4)]
+    return ends
+
+def test_iter_line_matches_get_line():
+    for ends in random_ends():
+        assert list(library.iter_line(*ends)) == library.get_line(*ends), ends
+
+def test_get_lines_matches_get_line():
+    ends = random_ends()
+    x1, y1, x2, y2 = np.array(ends).T
+    x, y, offsets = library.get_lines(x1, y1, x2, y2)
+    assert len(offsets) == len(ends) + 1
+    for k, line in enumerate(ends):
+        cells = list(zip(x[offsets[k]:offsets[k + 1]].tolist(),
+                         y[offsets[k]:offsets[k + 1]].tolist()))
+        assert cells == library.get_line(*line), line
+
+def test_get_lines_broadcasts_and_accepts_no_line():
+    x, y, offsets = library.get_lines(0, 0, [3, -2], [1, 5])
+    assert list(zip(x[offsets[1]:offsets[2]].tolist(), y[offsets[1]:offsets[2]].tolist())) == \
+        library.get_line(0, 0, -2, 5)
+    x, y, offsets = library.get_lines(0, 0, [], [])
+    assert len(x) == len(y) == 0
+    assert offsets.tolist() == [0]
+
+def test_lru_cache_evicts_least_recently_used():
+    evicted = []
+    cache = library.LRUCache(3, on_evict=lambda key, value: evicted.append((key, value)))
+    for key in 'abc':
+        cache.put(key, key.upper())
+    # Getting a is a use, storing b again too: c is the least recently used
+    assert cache.get('a') == 'A'
+    cache.put('b', 'B2')
+    cache.put('d', 'D')
+    assert evicted == [('c', 'C')]
+    assert 'c' not in cache and len(cache) == 3
+    cache.put('e', 'E')
+    assert evicted == [('c', 'C'), ('a', 'A')]
+    assert [cache.get(key) for key in 'bde'] == ['B2', 'D', 'E']
+    # A smaller maxsize evicts on the next put
+    cache.maxsize = 1
+    cache.put('f', 'F')
+    assert evicted[2:] == [('b', 'B2'), ('d', 'D'), ('e', 'E')]
+    assert len(cache) == 1
+
+def test_lru_cache_pop_and_clear_do_not_evict():
+    evicted = []
+    cache = library.LRUCache(2, on_evict=lambda key, value: evicted.append(key))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'missing') == 'missing'
+    cache.put('c', 3)
+    assert evicted == [] and len(cache) == 2
+    cache.clear()
+    assert evicted == [] and len(cache) == 0
+    assert cache.get('b') is None
+
+def test_lru_cache_counts_hits_and_misses():
+    cache = library.LRUCache(2)
+    assert cache.get('a', 0) == 0
+    cache.put('a', None)
+    # A stored None is a hit, not the default
+    assert cache.get('a', 0) is None
+    cache.get('a')
+    cache.get('b')
+    assert cache.info() == library.CacheInfo(hits=2, misses=2, maxsize=2, currsize=1)
+    # Neither pop nor clear change the counts
+    cache.pop('a')
+    cache.clear()
+    assert cache.info() == (2, 2, 2, 0)
+
+def test_disk_cache_stores_arrays(tmpdir):
+    cache = library.DiskCache(str(tmpdir.join('cache')))
+    key = cache.make_key({'col': 15}, 'DistanceMatrix', 1)
+    assert cache.get(key) is None
+    assert cache.put(key, {'a': np.arange(10), 'b': np.ones((3, 2), dtype=bool)})
+    arrays = cache.get(key)
+    assert sorted(arrays) == ['a', 'b']
+    assert np.array_equal(arrays['a'], np.arange(10))
+    assert arrays['b'].shape == (3, 2) and arrays['b'].all()
+    # The arrays are copy on write: the entry is not changed
+    arrays['a'][0] = 5
+    assert cache.get(key)['a'][0] == 0
+    assert cache.info()[:2] == (2, 1)
+
+def test_disk_cache_incomplete_entries_are_misses(tmpdir):
+    directory = tmpdir.join('cache')
+    cache = library.DiskCache(str(directory))
+    cache.put('complete', {'a': np.arange(10), 'b': np.arange(1000)})
+    # An empty entry, an entry missing an array and a truncated array
+    directory.mkdir('empty')
+    cache.put('missing', {'a': np.arange(10), 'b': np.arange(10)})
+    directory.join('missing', 'b.npy').remove()
+    cache.put('truncated', {'a': np.arange(1000)})
+    with open(str(directory.join('truncated', 'a.npy')), 'r+b') as f:
+        f.truncate(100)
+    for key in ('empty', 'missing', 'truncated'):
+        assert cache.get(key) is None
+        assert not directory.join(key).check()
+    assert sorted(cache.get('complete')) == ['a', 'b']
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+    cache = library.DiskCache(str(tmpdir.join('cache')), maxsize=20000)
+    array = np.zeros(1000)
+    cache.put('first', {'a': array})
+    cache.put('second', {'a': array})
+    # second is made the least recently used
+    tmpdir.join('cache', 'second').setmtime(tmpdir.join('cache', 'first').mtime() - 10)
+    cache.put('third', {'a': array})
+    assert cache.get('second') is None
+    assert cache.get('first') is not None and cache.get('third') is not None
@@ -0,0 +1,187 @@
+"""
+The pathfinding backends agree with each other and with a plain dijkstra
+on the whole grid, and their in place edits give the same graph as a
+fresh build on the edited terrain.
+"""
+import random
+
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+
+grid = pytest.importorskip('grid')
+
+BACKENDS = [grid.DistanceMatrix, grid.CostRaster]
+
+def random_terrain(rng, max_size=20):
+    "Returns row, col, the cells, the obstacles and the difficult terrains."
+    row, col = rng.randint(1, max_size), rng.randint(1, max_size)
+    cells = [(i, j) for i in range(col) for j in range(row)]
+    diff_terrains = set(rng.sample(cells, len(cells) // 5))
+    obstacles = set(rng.sample(cells, len(cells) // 4)) - diff_terrains
+    return row, col, cells, obstacles, diff_terrains
+
+def random_edits(rng, graph, cells, obstacles, diff_terrains, count=40):
+    "Edit the terrain of the graph in place and keep the sets in sync."
+    for _ in range(count):
+        cell = rng.choice(cells)
+        r = rng.random()
+        if r < .4:
+            graph.add_obstacle(*cell)
+            obstacles.add(cell)
+        elif r < .7:
+            graph.remove_obstacle(*cell)
+            obstacles.discard(cell)
+        elif r < .85:
+            graph.set_cost_factor(1.5, *cell)
+            diff_terrains.add(cell)
+        else:
+            graph.set_cost_factor(1., *cell)
+            diff_terrains.discard(cell)
+
+def path_cost(graph, start, path):
+    "Returns the cost of the path from start, following the moves of the graph."
+    cost, cell = 0., graph.from_coord_to_cell_number(*start)
+    for step in path:
+        other = graph.from_coord_to_cell_number(*step)
+        cost += dict(graph._neighbours(cell))[other]
+        cell = other
+    return cost
+
+def as_coords(cells):
+    return [tuple(int(x) for x in cell) for cell in cells]
+
+def test_distance_matrix_edits_match_fresh_build():
+    rng = random.Random(0)
+    for _ in range(40):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng, 12)
+        graph = grid.DistanceMatrix(row, col, obstacles=obstacles, cf=1.5,
+                                    diff_terrains=diff_terrains)
+        random_edits(rng, graph, cells, obstacles, diff_terrains)
+        fresh = grid.DistanceMatrix(row, col, obstacles=obstacles, cf=1.5,
+                                    diff_terrains=diff_terrains)
+        assert np.array_equal(graph.dist_mat.indptr, fresh.dist_mat.indptr)
+        assert np.array_equal(graph.dist_mat.indices, fresh.dist_mat.indices)
+        assert np.array_equal(graph.dist_mat.data, fresh.dist_mat.data)
+
+@pytest.mark.parametrize('Backend', BACKENDS)
+def test_obstacle_on_difficult_terrain_blocks_the_cell(Backend):
+    graph = Backend(5, 5, obstacles=[], cf=1.5, diff_terrains=[(2, 2)])
+    graph.add_obstacle(2, 2)
+    cells, _ = graph.get_reachable_cells(0, 0, 10)
+    assert (2, 2) not in as_coords(cells)
+    assert graph._neighbours(graph.from_coord_to_cell_number(2, 2)) == []
+
+def test_cost_raster_matches_distance_matrix():
+    rng = random.Random(1)
+    for _ in range(100):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng)
+        matrix = grid.DistanceMatrix(row, col, obstacles=obstacles, cf=1.5,
+                                     diff_terrains=diff_terrains)
+        raster = grid.CostRaster(row, col, obstacles=obstacles, cf=1.5,
+                                 diff_terrains=diff_terrains)
+        for cell in range(row * col):
+            assert sorted(matrix._neighbours(cell)) == sorted(raster._neighbours(cell))
+        free = [cell for cell in cells if cell not in obstacles]
+        if not free:
+            continue
+        start, goal = rng.choice(free), rng.choice(free)
+        dist = dijkstra(matrix.dist_mat, indices=matrix.from_coord_to_cell_number(*start))
+        expected = dist[matrix.from_coord_to_cell_number(*goal)]
+        for graph in (matrix, raster):
+            path = graph.find_path(start, goal)
+            if path is None:
+                assert np.isinf(expected)
+            else:
+                assert path_cost(graph, start, path) == pytest.approx(expected)
+
+@pytest.mark.parametrize('Backend', BACKENDS)
+def test_reachable_cells_match_dijkstra(Backend):
+    rng = random.Random(2)
+    for _ in range(100):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng)
+        graph = Backend(row, col, obstacles=obstacles, cf=1.5,
+                        diff_terrains=diff_terrains)
+        i, j = rng.choice(cells)
+        speed = rng.randint(0, 7)
+        reachable, predecessor = graph.get_reachable_cells(i, j, speed)
+        dist = dijkstra(graph._matrix(), indices=graph.from_coord_to_cell_number(i, j))
+        expected = [graph.from_cell_number_to_coord(cell)
+                    for cell in np.flatnonzero(dist <= speed)]
+        assert sorted(as_coords(reachable)) == sorted(as_coords(expected))
+        for cell in as_coords(reachable):
+            if cell != (i, j):
+                path = list(graph.reconstruct_path(i, j, cell[0], cell[1], predecessor))
+                assert path_cost(graph, (i, j), path) == pytest.approx(
+                        dist[graph.from_coord_to_cell_number(*cell)])
+
+@pytest.mark.parametrize('Backend', BACKENDS)
+def test_reachable_cells_many_matches_single_searches(Backend, monkeypatch):
+    # Small chunks, so the searches are split in several dijkstra calls
+    monkeypatch.setattr(Backend, 'CHUNK', 2)
+    rng = random.Random(3)
+    for _ in range(100):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng, 25)
+        graph = Backend(row, col, obstacles=obstacles, cf=1.5,
+                        diff_terrains=diff_terrains)
+        origins = [rng.choice(cells) for _ in range(rng.randint(1, 7))]
+        speeds = [rng.randint(0, 7) for _ in origins]
+        results = graph.get_reachable_cells_many(origins, speeds)
+        assert len(results) == len(origins)
+        for (i, j), speed, (reachable, predecessor) in zip(origins, speeds, results):
+            expected, expected_predecessor = graph.get_reachable_cells(i, j, speed)
+            assert as_coords(reachable) == as_coords(expected)
+            assert set(predecessor) == set(expected_predecessor)
+    assert graph.get_reachable_cells_many([], []) == []
+
+@pytest.mark.parametrize('Backend', BACKENDS)
+def test_distance_field_matches_dijkstra(Backend):
+    rng = random.Random(4)
+    for _ in range(60):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng)
+        graph = Backend(row, col, obstacles=obstacles, cf=1.5,
+                        diff_terrains=diff_terrains)
+        free = [cell for cell in cells if cell not in obstacles]
+        if not free:
+            continue
+        targets = rng.sample(free, min(len(free), rng.randint(1, 3)))
+        field = graph.get_distance_field(targets)
+        # The cost to the closest target, on the reversed moves
+        reversed_moves = graph._matrix().T.tocsr()
+        expected = np.min([dijkstra(reversed_moves, indices=graph.from_coord_to_cell_number(*target))
+                           for target in targets], axis=0)
+        assert np.array_equal(np.isinf(field.dist), np.isinf(expected))
+        finite = ~np.isinf(expected)
+        assert np.allclose(field.dist[finite], expected[finite])
+        for cell in free:
+            if cell in targets or np.isinf(field.cost(*cell)):
+                assert field.next_step(*cell) is None
+                continue
+            path = field.path(*cell)
+            assert tuple(int(x) for x in path[-1]) in targets
+            assert path_cost(graph, cell, path) == pytest.approx(field.cost(*cell))
+
+@pytest.mark.parametrize('Backend', BACKENDS)
+def test_cluster_graph_edits_match_fresh_build(Backend):
+    rng = random.Random(5)
+    for _ in range(60):
+        row, col, cells, obstacles, diff_terrains = random_terrain(rng, 40)
+        graph = Backend(row, col, obstacles=obstacles, cf=1.5,
+                        diff_terrains=diff_terrains)
+        clusters = grid.ClusterGraph(graph, rng.randint(2, 9))
+        random_edits(rng, graph, cells, obstacles, diff_terrains, 10)
+        fresh = grid.ClusterGraph(Backend(row, col, obstacles=obstacles, cf=1.5,
+                                          diff_terrains=diff_terrains), clusters.size)
+        assert clusters.borders == fresh.borders
+        assert dict((node, crossings) for node, crossings in clusters.crossings.items() if crossings) == \
+               dict((node, crossings) for node, crossings in fresh.crossings.items() if crossings)
+        assert clusters.paths == fresh.paths
+        free = [cell for cell in cells if cell not in obstacles]
+        for _ in range(5 if free else 0):
+            start, goal = rng.choice(free), rng.choice(free)
+            path, shortest = clusters.find_path(start, goal), graph.find_path(start, goal)
+            assert (path is None) == (shortest is None)
+            if path:
+                assert tuple(int(x) for x in path[-1]) == goal
+                # Near shortest, never shorter
+                assert path_cost(graph, start, path) >= path_cost(graph, start, shortest) - 1e-9
@@ -0,0 +1,38 @@
+"""
+The array functions of simplexnoise give the same values as the scalar
+functions, bit for bit.
+"""
+import numpy as np
+import pytest
+
+import simplexnoise
+
+def random_coords(dims, count=2000, seed=1):
+    "Random coords, with the first 50 points on ties between x and y."
+    rng = np.random.RandomState(seed)
+    coords = [rng.uniform(-300, 300, count) for _ in range(dims)]
+    coords[0][:50] = np.round(coords[0][:50])
+    coords[1][:50] = coords[0][:50]
+    return coords
+
+@pytest.mark.parametrize('dims', [2, 3, 4])
+def test_raw_noise_array(dims):
+    coords = random_coords(dims)
+    raw_noise = getattr(simplexnoise, 'raw_noise_%dd' % dims)
+    raw_noise_array = getattr(simplexnoise, 'raw_noise_%dd_array' % dims)
+    expected = np.array([raw_noise(*point) for point in zip(*coords)])
+    assert np.array_equal(raw_noise_array(*coords), expected)
+
+@pytest.mark.parametrize('dims', [2, 3, 4])
+def test_scaled_octave_noise_array(dims):
+    coords = random_coords(dims)
+    noise = getattr(simplexnoise, 'scaled_octave_noise_%dd' % dims)
+    noise_array = getattr(simplexnoise, 'scaled_octave_noise_%dd_array' % dims)
+    expected = np.array([noise(3, .5, .1, 0, 255, *point) for point in zip(*coords)])
+    assert np.array_equal(noise_array(3, .5, .1, 0, 255, *coords), expected)
+
+def test_noise_array_keeps_shape():
+    x, y = np.mgrid[0:7, 0:5]
+    values = simplexnoise.raw_noise_2d_array(x, y)
+    assert values.shape == (7, 5)
+    assert values[3, 2] == simplexnoise.raw_noise_2d(3, 2)
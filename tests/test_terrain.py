@@ -0,0 +1,28 @@
+
+import numpy as np
+import pytest
+
+import simplexnoise
+import terrain
+
+def scalar_mask(params, col, row):
+    "The noise mask computed one cell at a time, as the terrain used to be."
+    mask = np.zeros((col, row), dtype=bool)
+    for i in range(col):
+        for j in range(row):
+            v = simplexnoise.scaled_octave_noise_2d(
+                    params['octave'], params['persistance'], params['freq'],
+                    0, 255, i + params['x_off'], j + params['y_off'])
+            c = max(v - params['sparsity'], 0)
+            mask[i, j] = 255 - params['density'] ** c * 255 > 0.
+    return mask
+
+@pytest.mark.parametrize('processes, tile_size', [(1, 256), (1, 7), (2, 7)])
+def test_tiled_masks_match_scalar_noise(processes, tile_size, battlemap):
+    layers = [battlemap['difficult terrain'], battlemap['obstacle']]
+    col, row = 23, 17
+    masks = terrain.generate_masks(col, row, layers, processes, tile_size)
+    assert len(masks) == len(layers)
+    for mask, layer in zip(masks, layers):
+        assert mask.shape == (col, row)
+        assert np.array_equal(mask, scalar_mask(layer, col, row))
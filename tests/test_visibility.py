@@ -0,0 +1,173 @@
+"""
+The indexes of the grid give the same answers as a brute force search:
+lines of sight, ship queries and fog of war, also after edits.
+"""
+import random
+
+import numpy as np
+import pytest
+
+import library
+
+grid = pytest.importorskip('grid')
+
+class Weapon(object):
+    def __init__(self, range):
+        self.range = range
+
+class Ship(object):
+    def __init__(self, player, weapon_range=None):
+        self.player = player
+        self.weapon = Weapon(weapon_range) if weapon_range is not None else None
+
+def random_graph(rng, row, col, density=.15):
+    cells = [(i, j) for i in range(col) for j in range(row)]
+    obstacles = rng.sample(cells, int(len(cells) * density))
+    return grid.DistanceMatrix(row, col, obstacles=obstacles), cells
+
+def toggle_obstacle(graph, i, j):
+    if graph.obstacle[graph.from_coord_to_cell_number(i, j)]:
+        graph.remove_obstacle(i, j)
+    else:
+        graph.add_obstacle(i, j)
+
+def test_line_of_sight_matches_walking_the_line():
+    rng = random.Random(0)
+    graph, cells = random_graph(rng, 25, 30)
+    # A small cache, so the windows are evicted and built again
+    line_of_sight = grid.LineOfSight(graph, radius=5, maxsize=20)
+    blockers = np.array(rng.sample(cells, 20))
+    occupied = set(map(tuple, blockers.tolist()))
+    for t in range(3000):
+        if t % 100 == 0:
+            toggle_obstacle(graph, *rng.choice(cells))
+        start, end = rng.choice(cells), rng.choice(cells)
+        line = library.get_line(start[0], start[1], end[0], end[1])
+        hidden = any(graph.obstacle[graph.from_coord_to_cell_number(i, j)]
+                     for i, j in line)
+        assert line_of_sight.is_hidden(start, end) == hidden
+        assert line_of_sight.get_line(start, end) == line
+        # With the blockers between both ends
+        targets = np.array(rng.sample(cells, 10))
+        visible = line_of_sight.are_visible(start, targets, blockers)
+        for target, seen in zip(map(tuple, targets.tolist()), visible.tolist()):
+            line = library.get_line(start[0], start[1], target[0], target[1])
+            if max(abs(target[0] - start[0]), abs(target[1] - start[1])) > 5:
+                assert seen == -1
+                continue
+            expected = not any(graph.obstacle[graph.from_coord_to_cell_number(i, j)]
+                               for i, j in line) and \
+                       not any(cell in occupied for cell in line[1:-1])
+            assert seen == expected, (start, target)
+
+@pytest.mark.parametrize('bucket_size', [1, 3, 8, 50])
+def test_ship_table_matches_brute_force(bucket_size):
+    rng = random.Random(bucket_size)
+    table = grid.ShipTable(bucket_size)
+    for _ in range(1000):
+        r = rng.random()
+        if r < .3 or len(table) < 3:
+            table.add(Ship(rng.choice('abc')), rng.randrange(-5, 120), rng.randrange(100))
+        elif r < .4:
+            table.remove(rng.choice(table.ships))
+        elif r < .6:
+            table.move(rng.choice(table.ships), rng.randrange(100), rng.randrange(100))
+        i, j = rng.randrange(-10, 130), rng.randrange(-10, 110)
+        player = rng.choice([None, 'a', 'b'])
+        cells = table.cells
+        if player is None:
+            kept = np.ones(len(table), dtype=bool)
+        else:
+            kept = table.owners != table.owner_id(player)
+        distance = np.hypot(cells[:, 0] - i, cells[:, 1] - j)
+        radius = rng.choice([0, 1, 1.5, 5, 10.3, 200])
+        assert table.in_radius(i, j, radius, player).tolist() == \
+            np.flatnonzero(kept & (distance <= radius)).tolist()
+        left, bottom = rng.randrange(-10, 100), rng.randrange(-10, 100)
+        right, top = left + rng.randrange(60), bottom + rng.randrange(60)
+        inside = ((cells[:, 0] >= left) & (cells[:, 0] < right) &
+                  (cells[:, 1] >= bottom) & (cells[:, 1] < top))
+        assert table.in_rect(left, bottom, right, top, player).tolist() == \
+            np.flatnonzero(kept & inside).tolist()
+        k = rng.choice([0, 1, 3, 10, 1000])
+        nearest = table.nearest(i, j, k, player)
+        expected = np.flatnonzero(kept)[np.argsort(distance[kept], kind='mergesort')][:k]
+        assert len(nearest) == len(expected)
+        assert np.allclose(distance[nearest], distance[expected])
+        assert sum(len(ships) for ships in table.buckets.values()) == len(table)
+
+def test_field_of_view_open_field_and_shadow():
+    graph = grid.DistanceMatrix(30, 30)
+    visibility = grid.FleetVisibility(graph, 5)
+    disk = set(x + y * 30 for x in range(30) for y in range(30)
+               if (x - 10) ** 2 + (y - 10) ** 2 <= 25)
+    assert set(visibility.field_of_view(10, 10, 5).tolist()) == disk
+    # Clipped by the edges of the grid
+    assert set(visibility.field_of_view(0, 0, 3).tolist()) == \
+        set(x + y * 30 for x in range(4) for y in range(4) if x * x + y * y <= 9)
+    # An obstacle is seen, not the cells behind it
+    graph.add_obstacle(11, 10)
+    cells = set(visibility.field_of_view(10, 10, 5).tolist())
+    assert 11 + 10 * 30 in cells
+    assert 12 + 10 * 30 not in cells and 14 + 10 * 30 not in cells
+    assert 9 + 10 * 30 in cells
+
+def test_fleet_visibility_matches_fresh_views():
+    rng = random.Random(4)
+    graph, cells = random_graph(rng, 40, 40)
+    visibility = grid.FleetVisibility(graph, 5)
+    positions = {}
+    for k in range(12):
+        ship = Ship('ab'[k % 2], rng.choice([None, 3, 8]))
+        positions[ship] = rng.choice(cells)
+        visibility.update(ship, *positions[ship])
+    for _ in range(200):
+        r = rng.random()
+        ship = rng.choice(list(positions))
+        if r < .5:
+            positions[ship] = rng.choice(cells)
+            visibility.update(ship, *positions[ship])
+        elif r < .55:
+            # The weapon jams or is changed, the ship stays in its cell
+            ship.weapon = rng.choice([None, Weapon(3), Weapon(8)])
+            visibility.update_ranges()
+        elif r < .6:
+            # Or changes with the view updated on the next move
+            ship.weapon = rng.choice([None, Weapon(3), Weapon(8)])
+            visibility.update(ship, *positions[ship])
+        elif r < .65 and len(positions) > 3:
+            del positions[ship]
+            visibility.remove(ship)
+        else:
+            toggle_obstacle(graph, *rng.choice(cells))
+    fresh = grid.FleetVisibility(graph, 5)
+    for ship, cell in positions.items():
+        fresh.update(ship, *cell)
+    assert set(visibility.views) == set(positions)
+    for ship, (cell, seen, radius) in visibility.views.items():
+        assert cell == positions[ship]
+        assert radius == visibility.get_range(ship)
+        assert sorted(seen.tolist()) == sorted(fresh.views[ship][1].tolist())
+    for player in 'ab':
+        assert dict(visibility.seen[player]) == dict(fresh.seen[player])
+        assert np.array_equal(visibility.visible_mask(player), fresh.visible_mask(player))
+
+def test_jammed_weapon_falls_back_to_sensor_range():
+    graph = grid.DistanceMatrix(30, 30)
+    visibility = grid.FleetVisibility(graph, 5)
+    ship = Ship('a', 8)
+    visibility.update(ship, 10, 10)
+    assert len(visibility.views[ship][1]) == len(visibility.field_of_view(10, 10, 8))
+    ship.weapon = None
+    assert visibility.get_range(ship) == 5
+    # The view shrinks without the ship moving
+    visibility.update_ranges()
+    assert sorted(visibility.views[ship][1].tolist()) == \
+        sorted(visibility.field_of_view(10, 10, 5).tolist())
+    assert dict(visibility.seen['a']) == \
+        dict((cell, 1) for cell in visibility.field_of_view(10, 10, 5).tolist())
+    # And grows back with another weapon, also through update in the same cell
+    ship.weapon = Weapon(8)
+    visibility.update(ship, 10, 10)
+    assert sorted(visibility.views[ship][1].tolist()) == \
+        sorted(visibility.field_of_view(10, 10, 8).tolist())